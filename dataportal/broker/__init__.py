@@ -1,5 +1,7 @@
-from .simple_broker import (DataBroker, Header, get_events, get_table)
+from .simple_broker import (DataBroker, Header, get_events, get_table,
+                            iter_table, stacked_array)
 from .pims_readers import get_images
+from .retrieval import LazyArray
 
 from .handler_registration import register_builtin_handlers
 
@@ -0,0 +1,185 @@
+"""Asyncio counterparts to the DataBroker API.
+
+The metadatastore and filestore clients are blocking, so each query or
+retrieval runs on a thread pool and is awaited from the event loop.
+Independent pieces of work -- the EventDescriptors of several headers, the
+tables of several descriptors, the filling of several events -- are
+scheduled together. A semaphore bounds how many run at once, so that one
+large request cannot starve the others.
+
+This module requires Python 3.6 or later; it is not installed on older
+Pythons and is not imported by ``dataportal.broker``. Import it explicitly.
+
+Example
+-------
+>>> from dataportal.broker.aio import AsyncDataBroker
+>>> adb = AsyncDataBroker(max_concurrency=8)
+>>> header = await adb[-1]
+>>> headers = await adb(owner='nedbrainard')
+>>> table = await adb.get_table(headers)
+>>> async for event in adb.get_events(header):
+...     # do something
+"""
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from .stats import propagate
+from .simple_broker import (DataBroker, fill_event, _get_events,
+                            _header_descriptors, _header_list, _projection,
+                            _descriptor_table, _LazyHeader)
+
+
+logger = logging.getLogger(__name__)
+
+# Python 3.6 has no get_running_loop, but its get_event_loop returns the
+# running loop when called from a coroutine.
+_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+class AsyncDataBroker(object):
+    """
+    Search for runs and load their data without blocking the event loop.
+
+    Parameters
+    ----------
+    max_concurrency : int, optional
+        The most queries and retrievals that may run at once on behalf of
+        this broker, across all requests. 8 by default.
+    executor : concurrent.futures.Executor, optional
+        Where the blocking calls run. By default, a new ThreadPoolExecutor
+        with max_concurrency workers is used; close() shuts it down.
+    """
+    def __init__(self, max_concurrency=8, executor=None):
+        self._max_concurrency = max_concurrency
+        # The semaphore belongs to an event loop, so it is made in the loop
+        # that first uses it (and made again if another loop takes over).
+        self._semaphore = None
+        self._loop = None
+        self._own_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self._executor = executor
+
+    def close(self):
+        "Shut down the executor, if this broker created it."
+        if self._own_executor:
+            self._executor.shutdown(wait=False)
+
+    async def _run(self, func, *args, **kwargs):
+        "Run a blocking function on the executor, within the limit."
+        loop = _running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+            self._loop = loop
+        async with self._semaphore:
+            return await loop.run_in_executor(
+                self._executor,
+                propagate(functools.partial(func, *args, **kwargs)))
+
+    def __getitem__(self, key):
+        """
+        Await Header(s) using the same DWIM keys as DataBroker[...].
+
+        Example
+        -------
+        >>> header = await adb[-1]
+        """
+        return self._run(_resolved, DataBroker.__getitem__, key)
+
+    def __call__(self, **kwargs):
+        """
+        Await Headers matching search criteria, like DataBroker(...).
+
+        Example
+        -------
+        >>> headers = await adb(owner='nedbrainard')
+        """
+        return self._run(_resolved, DataBroker, **kwargs)
+
+    async def get_table(self, headers, fields=None, fill=True,
+                        convert_times=True, stack_arrays=False):
+        """
+        Make a table (pandas.DataFrame) from given run(s).
+
+        The EventDescriptors of all the headers are looked up concurrently,
+        and then the tables of all the descriptors are built concurrently.
+        See dataportal.broker.get_table for the parameters.
+
+        Returns
+        -------
+        table : pandas.DataFrame
+        """
+        headers = _header_list(headers)
+        fields = set(fields or [])
+        descriptor_lists = await asyncio.gather(
+            *[self._run(_header_descriptors, header) for header in headers])
+        tasks = []
+        for descriptors in descriptor_lists:
+            for descriptor in descriptors:
+                keep = _projection(descriptor, fields)
+                if not keep:
+                    continue
+                tasks.append(self._run(_descriptor_table, descriptor, keep,
+                                       fill, convert_times, stack_arrays))
+        dfs = await asyncio.gather(*tasks)
+        if dfs:
+            return pd.concat(dfs)
+        else:
+            # edge case: no data
+            return pd.DataFrame()
+
+    async def get_events(self, headers, fields=None, fill=True,
+                         batch_size=100):
+        """
+        Asynchronously iterate over the Events of given run(s), in order.
+
+        Events are fetched in batches. The events of each batch are filled
+        concurrently. See dataportal.broker.get_events for the other
+        parameters.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of events fetched (and filled) per step. 100 by
+            default.
+
+        Yields
+        ------
+        event : Event
+        """
+        events = _get_events(headers, fields)
+        while True:
+            # The generator is only ever advanced by one thread at a time.
+            batch = await self._run(_take, events, batch_size)
+            if not batch:
+                return
+            if fill:
+                lazy = fill == 'lazy'
+                await asyncio.gather(
+                    *[self._run(fill_event, event, lazy) for event in batch])
+            for event in batch:
+                yield event
+
+
+def _resolved(func, *args, **kwargs):
+    """
+    Call a DataBroker lookup and resolve the lazy Headers it returns, so
+    that using them later does not block the event loop.
+    """
+    headers = func(*args, **kwargs)
+    for header in _header_list(headers):
+        if isinstance(header, _LazyHeader):
+            header._resolve()  # resolves the rest of its batch too
+    return headers
+
+
+def _take(iterator, n):
+    "Return a list of up to n items from iterator."
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) >= n:
+            break
+    return batch
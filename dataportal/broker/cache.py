@@ -0,0 +1,176 @@
+"""In-process caches shared by the broker and the readers built on it."""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import OrderedDict, namedtuple
+import threading
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """
+    A thread-safe mapping that evicts its least recently used entries.
+
+    Parameters
+    ----------
+    maxsize : int or None, optional
+        The capacity of the cache, measured in the units of getsizeof. If
+        None, the cache is unbounded. 128 by default.
+    getsizeof : callable, optional
+        Given a value, return its size. By default, every value has size 1,
+        so that maxsize is a number of entries.
+
+    Example
+    -------
+    >>> cache = LRUCache(maxsize=2)
+    >>> cache['a'] = 1
+    >>> cache.get('a')
+    1
+    >>> cache.info()
+    CacheInfo(hits=1, misses=0, maxsize=2, currsize=1)
+    """
+    def __init__(self, maxsize=128, getsizeof=None):
+        self._maxsize = maxsize
+        if getsizeof is None:
+            getsizeof = lambda value: 1
+        self._getsizeof = getsizeof
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._currsize = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    @maxsize.setter
+    def maxsize(self, val):
+        with self._lock:
+            self._maxsize = val
+            self._evict()
+
+    @property
+    def currsize(self):
+        return self._currsize
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        # Does not count as a hit or a miss, and does not refresh the key.
+        return key in self._data
+
+    def get(self, key, default=None):
+        "Return the value for key, or default, and record a hit or a miss."
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value  # Mark it most recently used.
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key, value):
+        size = self._getsizeof(value)
+        with self._lock:
+            self.pop(key)
+            if self._maxsize is not None and size > self._maxsize:
+                logger.debug("Not caching %r: larger than the whole cache",
+                             key)
+                return
+            self._data[key] = value
+            self._sizes[key] = size
+            self._currsize += size
+            self._evict()
+
+    def pop(self, key, default=None):
+        "Remove key and return its value, or default if it is not cached."
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._currsize -= self._sizes.pop(key)
+            return value
+
+    def clear(self):
+        "Drop every entry and reset the hit and miss counters."
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._currsize = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        "Report hits, misses, maxsize and currsize."
+        return CacheInfo(self.hits, self.misses, self._maxsize,
+                         self._currsize)
+
+    def _evict(self):
+        if self._maxsize is None:
+            return
+        while self._currsize > self._maxsize:
+            key, _ = self._data.popitem(last=False)
+            self._currsize -= self._sizes.pop(key)
+            logger.debug("Evicted %r from cache", key)
+
+
+DescriptorInfo = namedtuple('DescriptorInfo',
+                            ['fields', 'external_keys', 'is_external',
+                             'shapes', 'dtypes'])
+
+
+def descriptor_info(descriptor):
+    """
+    Summarize the data keys of an EventDescriptor, with memoization.
+
+    Descriptors never change once they are inserted, so the summary is
+    computed once per descriptor uid and shared by every caller.
+
+    Parameters
+    ----------
+    descriptor : EventDescriptor
+        Document or any object with the expected attributes
+
+    Returns
+    -------
+    info : DescriptorInfo
+        with the fields
+        - fields: tuple of data key names, sorted
+        - external_keys: frozenset of names whose data is stored externally
+        - is_external: dict mapping each name to a boolean
+        - shapes: dict mapping each name to a shape tuple, or None if the
+          descriptor does not specify one
+        - dtypes: dict mapping each name to its dtype as given in the
+          descriptor (e.g., 'number' or 'array'), or None
+    """
+    info = descriptor_info_cache.get(descriptor.uid)
+    if info is not None:
+        return info
+    data_keys = descriptor.data_keys
+    is_external = {}
+    shapes = {}
+    dtypes = {}
+    for data_key, data_key_dict in data_keys.items():
+        is_external[data_key] = bool(data_key_dict.get('external', False))
+        shape = data_key_dict.get('shape')
+        shapes[data_key] = tuple(shape) if shape is not None else None
+        dtypes[data_key] = data_key_dict.get('dtype')
+    external_keys = frozenset(k for k, v in is_external.items() if v)
+    info = DescriptorInfo(tuple(sorted(data_keys)), external_keys,
+                          is_external, shapes, dtypes)
+    descriptor_info_cache[descriptor.uid] = info
+    return info
+
+
+descriptor_info_cache = LRUCache(maxsize=10000)
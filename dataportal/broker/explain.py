@@ -0,0 +1,217 @@
+"""Describe the queries behind a DataBroker search without running it.
+
+The plan lists every query that ``DataBroker(**kwargs)`` would send to
+metadatastore, in order, with the number of documents each would match and
+the index (if any) that MongoDB could use to answer it. Index usage is
+judged from the collection's index definitions and the shape of the query;
+it is a heuristic, not MongoDB's own query plan.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import namedtuple
+import logging
+import six
+import metadatastore.commands as mc
+
+try:
+    from metadatastore.odm_templates import RunStart, RunStop, EventDescriptor
+except ImportError:
+    # This version of metadatastore does not expose its collections, so
+    # plans cannot include counts or indexes.
+    RunStart = RunStop = EventDescriptor = None
+
+
+logger = logging.getLogger(__name__)
+
+
+QueryPlan = namedtuple('QueryPlan', ['collection', 'query', 'sort', 'count',
+                                     'index', 'notes'])
+QueryPlan.__doc__ = """
+One query in the plan of a search.
+
+Fields
+------
+collection : str
+    name of the collection queried
+query : dict
+    the query document, as sent to MongoDB
+sort : list or None
+    (field, direction) pairs, if the results are sorted
+count : int or None
+    the number of documents the query would match, if estimated
+index : str or None
+    name of an index that could answer the query, or None if the query
+    would scan the collection, or 'unknown' if the indexes are unavailable
+notes : tuple
+    human-readable warnings and remarks
+"""
+
+# Operators that an index cannot answer selectively.
+_UNSELECTIVE = ('$ne', '$nin', '$not', '$where')
+
+
+def run_start_query(kwargs):
+    """
+    Translate DataBroker search criteria into a RunStart query document.
+
+    The human-friendly start_time and stop_time are converted as
+    find_run_starts would convert them.
+    """
+    query = dict(kwargs)
+    format_time = getattr(mc, '_format_time', None)
+    if format_time is not None:
+        format_time(query)  # modifies query in place
+    return query
+
+
+def _run_start_ids(run_start_uids):
+    """
+    Map RunStart uids to the ObjectIds by which other documents refer to
+    them, or return None if the collections are unavailable.
+    """
+    if RunStart is None:
+        return None
+    col = RunStart._get_collection()
+    return {doc['uid']: doc['_id'] for doc
+            in col.find({'uid': {'$in': list(run_start_uids)}},
+                        {'uid': 1, '_id': 1})}
+
+
+def _run_start_in(run_start_ids):
+    """
+    Make query criteria matching documents that refer to any of several runs,
+    given the ObjectIds of their RunStarts (see _run_start_ids).
+    """
+    # RunStops and EventDescriptors store the ObjectId of their RunStart in
+    # 'run_start_id'. The find_* functions interpret a 'run_start' keyword
+    # argument as a single Document or uid, so the set membership test is
+    # nested inside '$and' to pass it through to mongo untouched.
+    return {'$and': [{'run_start_id': {'$in': list(run_start_ids)}}]}
+
+
+def explain_search(kwargs, data_key_index, estimate=True):
+    """
+    Plan the queries for DataBroker(**kwargs); see DataBroker.explain.
+    """
+    kwargs = dict(kwargs)
+    data_key = kwargs.pop('data_key', None)
+    query = run_start_query(kwargs)
+    plans = [_plan(RunStart, 'run_start', query, [('time', -1)], estimate)]
+    if data_key is None:
+        return plans
+
+    # Only runs whose data keys are not indexed locally are looked up.
+    unindexed = None
+    if estimate and RunStart is not None:
+        col = RunStart._get_collection()
+        ids = {doc['uid']: doc['_id'] for doc
+               in col.find(query, {'uid': 1, '_id': 1})}
+        unindexed = data_key_index.unindexed(ids)
+        if not unindexed:
+            notes = ("The data keys of every matching run are already "
+                     "indexed locally, so no further queries are needed.",)
+            return [plans[0]._replace(notes=plans[0].notes + notes)]
+    run_start_ids = ([ids[uid] for uid in unindexed]
+                     if unindexed is not None else ['...'])
+    # The same criteria that the search itself sends; see _run_start_in.
+    in_query = _run_start_in(run_start_ids)
+    note = ("One query for all {0} runs whose data keys are not yet "
+            "indexed locally.".format(len(unindexed) if unindexed is not None
+                                      else 'matching'))
+    for template, name in ((RunStop, 'run_stop'),
+                           (EventDescriptor, 'event_descriptor')):
+        plan = _plan(template, name, in_query, None,
+                     estimate and unindexed is not None)
+        plans.append(plan._replace(notes=(note,) + plan.notes))
+    return plans
+
+
+def _plan(template, default_name, query, sort, estimate):
+    "Plan one query against the collection of an odm template."
+    notes = list(_query_notes(query))
+    if template is None:
+        return QueryPlan(default_name, query, sort, None, 'unknown',
+                         tuple(notes))
+    col = template._get_collection()
+    count = None
+    if estimate:
+        if hasattr(col, 'count_documents'):
+            count = col.count_documents(query)
+        else:
+            count = col.find(query).count()
+    index = _usable_index(col.index_information(), query, sort)
+    if index is None:
+        notes.append("No index covers the criteria; every document in "
+                     "{0} will be scanned.".format(col.name))
+    return QueryPlan(col.name, query, sort, count, index, tuple(notes))
+
+
+def _usable_index(indexes, query, sort):
+    """
+    Return the name of an index whose leading key is selectively queried
+    (or, failing that, matches the sort), or None.
+    """
+    fields = _selective_fields(query)
+    by_leading_key = {}
+    for name, info in six.iteritems(indexes):
+        by_leading_key.setdefault(info['key'][0][0], name)
+    for field in fields:
+        if field in by_leading_key:
+            return by_leading_key[field]
+    if sort and not fields:
+        # With no criteria at all, an index on the sort key is walked in
+        # order instead of sorting the whole collection.
+        return by_leading_key.get(sort[0][0])
+    return None
+
+
+def _selective_fields(query):
+    "List the fields that a query restricts in a way an index can use."
+    fields = []
+    for key, value in six.iteritems(query):
+        if key == '$and':
+            for clause in value:
+                fields.extend(_selective_fields(clause))
+        elif key.startswith('$'):
+            continue  # $or, $where, etc. are not considered
+        elif isinstance(value, dict):
+            if any(op in value for op in _UNSELECTIVE):
+                continue
+            regex = value.get('$regex')
+            if regex is not None and not _anchored(regex):
+                continue
+            fields.append(key)
+        else:
+            fields.append(key)
+    return fields
+
+
+def _query_notes(query):
+    "Yield warnings about parts of a query that are costly."
+    if not query:
+        yield "There are no criteria; every run matches."
+    for key, value in six.iteritems(query):
+        if key == '$and':
+            for clause in value:
+                for note in _query_notes(clause):
+                    yield note
+        elif key == '$where':
+            yield ("$where runs JavaScript against every document and "
+                   "cannot use an index.")
+        elif key == '$or':
+            yield ("$or can only use indexes if every clause can; consider "
+                   "separate searches.")
+        elif isinstance(value, dict):
+            regex = value.get('$regex')
+            if regex is not None and not _anchored(regex):
+                yield ("The regex on {0!r} is not anchored with '^', so it "
+                       "must test every value.".format(key))
+            for op in _UNSELECTIVE:
+                if op in value:
+                    yield ("{0} on {1!r} matches most documents and cannot "
+                           "use an index selectively.".format(op, key))
+
+
+def _anchored(regex):
+    pattern = getattr(regex, 'pattern', regex)  # compiled or str
+    return isinstance(pattern, six.string_types) and pattern.startswith('^')
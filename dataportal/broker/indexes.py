@@ -0,0 +1,140 @@
+"""In-process indexes that spare the broker from repeating database scans.
+
+The indexes in this module hold no database connection of their own. The
+broker feeds them documents it has already fetched, and consults them before
+issuing new queries.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from bisect import bisect_left, insort
+from collections import defaultdict
+import heapq
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class DataKeyIndex(object):
+    """
+    An inverted index from data key to the uids of the runs that recorded it.
+
+    Runs are added incrementally as they are encountered. A run that has been
+    stopped cannot gain any more EventDescriptors, so once a stopped run is
+    indexed it is never looked up again. Runs that are still open are
+    re-indexed each time they are encountered.
+
+    Example
+    -------
+    >>> index = DataKeyIndex()
+    >>> index.add('abc', ['motor1', 'det'], complete=True)
+    >>> index.runs_with('motor1')
+    {'abc'}
+    """
+    def __init__(self):
+        self._runs_by_key = defaultdict(set)
+        self._complete = set()
+
+    def __contains__(self, run_start_uid):
+        return run_start_uid in self._complete
+
+    def __len__(self):
+        return len(self._complete)
+
+    def add(self, run_start_uid, data_keys, complete=False):
+        """
+        Record the data keys of a run.
+
+        Parameters
+        ----------
+        run_start_uid : str
+        data_keys : iterable
+            names of the data keys in the run's EventDescriptors
+        complete : bool, optional
+            True if the run has been stopped, so that data_keys is final.
+            False by default.
+        """
+        for data_key in data_keys:
+            self._runs_by_key[data_key].add(run_start_uid)
+        if complete:
+            self._complete.add(run_start_uid)
+
+    def unindexed(self, run_start_uids):
+        """
+        Return the uids that are not (completely) indexed yet, in order.
+        """
+        return [uid for uid in run_start_uids if uid not in self._complete]
+
+    def runs_with(self, data_key):
+        "Return the set of uids of indexed runs that recorded data_key."
+        return set(self._runs_by_key.get(data_key, ()))
+
+    def clear(self):
+        "Forget everything."
+        self._runs_by_key.clear()
+        self._complete.clear()
+
+
+class UidPrefixIndex(object):
+    """
+    A sorted collection of run uids supporting prefix lookups by bisection.
+
+    The index only knows about the uids it has been given, so it cannot prove
+    that a prefix is unique. It can prove that a prefix is ambiguous, which
+    spares the database a query.
+
+    Example
+    -------
+    >>> index = UidPrefixIndex()
+    >>> index.update(['a23jslk', 'a23k0f', 'b8812e'])
+    >>> index.matches('a23')
+    ['a23jslk', 'a23k0f']
+    """
+    def __init__(self):
+        self._uids = []
+
+    def __contains__(self, uid):
+        i = bisect_left(self._uids, uid)
+        return i < len(self._uids) and self._uids[i] == uid
+
+    def __len__(self):
+        return len(self._uids)
+
+    def add(self, uid):
+        "Add a uid. Adding one that is already known is a no-op."
+        if uid not in self:
+            insort(self._uids, uid)
+
+    def update(self, uids):
+        """
+        Add several uids.
+
+        The new uids are sorted and merged into the index in one pass, so
+        adding m uids to n costs O(m log m + n), not O(m n).
+        """
+        new = sorted(uid for uid in set(uids) if uid not in self)
+        if new:
+            self._uids = list(heapq.merge(self._uids, new))
+
+    def matches(self, prefix, limit=None):
+        """
+        Return the known uids that start with prefix, in sorted order.
+
+        Parameters
+        ----------
+        prefix : str
+        limit : int, optional
+            Stop after this many matches. By default, return them all.
+        """
+        result = []
+        i = bisect_left(self._uids, prefix)
+        while i < len(self._uids) and self._uids[i].startswith(prefix):
+            if limit is not None and len(result) >= limit:
+                break
+            result.append(self._uids[i])
+            i += 1
+        return result
+
+    def clear(self):
+        "Forget everything."
+        del self._uids[:]
@@ -1,9 +1,29 @@
 """This module contains "PIMS readers" (see github.com/soft-matter/pims) that
 take in headers and detector aliases and return a sliceable generator of arrays."""
 
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+import threading
+import logging
+import numpy as np
 from pims import FramesSequence, Frame
-from . import get_events
-from filestore.api import retrieve
+from .cache import LRUCache, descriptor_info
+from .retrieval import bulk_retrieve, retrieve, _memory_map
+from .stats import propagate
+from .simple_broker import (_header_descriptors, _header_list, find_events,
+                            _count_events, _find_raw_events, Event)
+
+
+logger = logging.getLogger(__name__)
+
+# Descriptors use these JSON type names for 'dtype'; they are not numpy dtypes.
+_JSON_TYPES = ('number', 'array', 'string', 'integer', 'boolean')
+
+# Frames recently read by any Images, keyed by datum id and bounded by bytes.
+# Set frame_cache.maxsize to change the budget.
+frame_cache = LRUCache(maxsize=512 * 2**20,
+                       getsizeof=lambda frame: frame.nbytes)
+
 
 def get_images(headers, name):
     """
@@ -26,15 +46,34 @@ def get_images(headers, name):
 
 
 class Images(FramesSequence):
-    def __init__(self, headers, name):
+    def __init__(self, headers, name, page_size=1000, prefetch=0,
+                 prefetch_workers=2, cache=True):
         """
         Load images from a detector for given Header(s).
 
+        Opening is fast even for very long runs: the frames of each
+        descriptor are counted, not fetched, and their datum ids are looked
+        up a page at a time (in seq_num order), as frames are accessed.
+
         Parameters
         ----------
         headers : Header or list of Headers
         name : str
             field name (data key) of a detector
+        page_size : int, optional
+            number of datum ids looked up per query. 1000 by default.
+        prefetch : int, optional
+            If positive, watch for sequential, reverse or strided access
+            and read up to this many of the frames predicted to come next
+            in the background. Seeking elsewhere cancels the stale reads.
+            0 (off) by default.
+        prefetch_workers : int, optional
+            number of threads reading ahead. 2 by default.
+        cache : bool, optional
+            If True, keep frames in the module's frame_cache, an LRU cache
+            bounded by bytes that every Images shares. Each frame returned
+            is a copy of the cached one, so it may be modified freely.
+            True by default.
 
         Example
         -------
@@ -43,24 +82,355 @@ class Images(FramesSequence):
         >>> for image in images:
                 # do something
         """
-        events = get_events(headers, [name], fill=False)
-        self._datum_uids = [event.data[name] for event in events]
-        self._len = len(self._datum_uids)
-        example_frame = retrieve(self._datum_uids[0])
-        self._dtype = example_frame.dtype
-        self._shape = example_frame.shape
+        if page_size < 1:
+            raise ValueError("page_size must be at least 1")
+        self._name = name
+        self._page_size = page_size
+        # Each segment is the frames of one descriptor:
+        # (descriptor, number of frames)
+        self._segments = []
+        self._offsets = []  # index of the first frame of each segment
+        self._header_segments = []  # the segments of each header
+        self._len = 0
+        self._pages = {}  # (segment, page) -> list of datum ids
+        for header in _header_list(headers):
+            self._header_segments.append([])
+            for descriptor in _header_descriptors(header):
+                info = descriptor_info(descriptor)
+                if name not in info.fields:
+                    continue
+                if name not in info.external_keys:
+                    raise ValueError("The field {0} is not stored externally "
+                                     "in filestore.".format(name))
+                if Event is not None:
+                    count = _count_events(descriptor)
+                else:
+                    # The Events cannot be counted or paged, so look up
+                    # every datum id now.
+                    datum_ids = self._all_datum_ids(descriptor)
+                    count = len(datum_ids)
+                    for page, start in enumerate(range(0, count, page_size)):
+                        self._pages[(len(self._segments), page)] = \
+                            datum_ids[start:start + page_size]
+                if not count:
+                    continue
+                self._header_segments[-1].append(len(self._segments))
+                self._segments.append((descriptor, count))
+                self._offsets.append(self._len)
+                self._len += count
+        self._lock = threading.Lock()
+        self._metadata = {}  # segment -> (frame shape, dtype)
+        self._cache = cache
+        if prefetch > 0:
+            self._read_ahead = _ReadAhead(self._read, len(self), prefetch,
+                                          prefetch_workers)
+        else:
+            self._read_ahead = None
+
+    def close(self):
+        "Stop any reading ahead."
+        if self._read_ahead is not None:
+            self._read_ahead.close()
+
+    def _frame_index(self, i):
+        "Wrap a negative frame number once, and check that it is in range."
+        j = i + self._len if i < 0 else i
+        if not 0 <= j < self._len:
+            raise IndexError("Frame {0} is out of range; there are {1} "
+                             "frames.".format(i, self._len))
+        return j
+
+    def _datum_id(self, i):
+        """
+        Return the datum id of frame i (not negative; see _frame_index),
+        looking up its page if needed.
+        """
+        if not 0 <= i < self._len:
+            raise IndexError("Frame {0} is out of range; there are {1} "
+                             "frames.".format(i, self._len))
+        segment = bisect_right(self._offsets, i) - 1
+        j = i - self._offsets[segment]
+        page, k = divmod(j, self._page_size)
+        datum_ids = self._pages.get((segment, page))
+        if datum_ids is None:
+            datum_ids = self._load_page(segment, page)
+        return datum_ids[k]
+
+    def _all_datum_ids(self, descriptor):
+        events = sorted(find_events(descriptor=descriptor),
+                        key=lambda event: event['seq_num'])
+        return [event['data'][self._name] for event in events]
+
+    def _load_page(self, segment, page):
+        descriptor, count = self._segments[segment]
+        start = page * self._page_size
+        stop = min(start + self._page_size, count)
+        # Paging by position in seq_num order, not by seq_num, makes no
+        # assumption about where the seq_nums start or whether they have gaps.
+        events = _find_raw_events(descriptor, {'data.' + self._name: 1},
+                                  sort=[('seq_num', 1)], skip=start,
+                                  limit=stop - start)
+        datum_ids = [event['data'][self._name] for event in events]
+        if len(datum_ids) != stop - start:
+            raise ValueError("Descriptor {0} lost Events while its frames "
+                             "were being read.".format(descriptor['uid']))
+        with self._lock:
+            self._pages[(segment, page)] = datum_ids
+        logger.debug("Looked up datum ids %d-%d of descriptor %s", start,
+                     stop, descriptor['uid'])
+        return datum_ids
+
+    def _segment_metadata(self, segment):
+        """
+        Return the (shape, dtype) of the frames of one segment.
+
+        The header of the first frame's file is used if the format can be
+        memory-mapped; it describes the data exactly. Otherwise the
+        descriptor's shape and dtype are used. Only if the descriptor does
+        not give both is a frame read.
+        """
+        metadata = self._metadata.get(segment)
+        if metadata is not None:
+            return metadata
+        offset = self._offsets[segment]
+        datum_id = self._datum_id(offset)
+        mapped = _memory_map(datum_id)
+        if mapped is not None:
+            metadata = tuple(mapped.shape), mapped.dtype
+        else:
+            info = descriptor_info(self._segments[segment][0])
+            shape = info.shapes[self._name]
+            dtype = _numpy_dtype(info.dtypes[self._name])
+            if shape is not None and dtype is not None:
+                metadata = shape, dtype
+            else:
+                logger.debug("Reading frame %d to learn its shape and dtype",
+                             offset)
+                frame = np.asarray(self._read(offset))
+                metadata = frame.shape, frame.dtype
+        self._metadata[segment] = metadata
+        return metadata
+
+    def _first_metadata(self):
+        if not self._len:
+            raise ValueError("There are no frames.")
+        return self._segment_metadata(0)
 
     @property
     def pixel_type(self):
-        return self._dtype
+        return self._first_metadata()[1]
 
     @property
     def frame_shape(self):
-        return self._shape
+        """
+        The shape of the frames, or of the first header's frames if they
+        differ between headers (see frame_shapes and uniform_shape).
+        """
+        return self._first_metadata()[0]
+
+    @property
+    def frame_shapes(self):
+        """
+        The frame shape of each header, in order, or None for a header
+        without frames.
+        """
+        shapes = []
+        for segments in self._header_segments:
+            if segments:
+                shapes.append(self._segment_metadata(segments[0])[0])
+            else:
+                shapes.append(None)
+        return shapes
+
+    @property
+    def uniform_shape(self):
+        "Whether every frame has the same shape."
+        return len(set(self._segment_metadata(segment)[0] for segment
+                       in range(len(self._segments)))) <= 1
+
+    def _batch_metadata(self, indices):
+        "Return the (shape, dtype) shared by the frames at indices, or raise."
+        if not indices:
+            return self._first_metadata()
+        segments = sorted(set(bisect_right(self._offsets, i) - 1
+                              for i in indices))
+        shape, dtype = self._segment_metadata(segments[0])
+        for segment in segments[1:]:
+            other = self._segment_metadata(segment)[0]
+            if other != shape:
+                raise ValueError("The frames change shape from {0} to {1} "
+                                 "(at frame {2}), so they cannot be read "
+                                 "into one array.".format(
+                                     shape, other, self._offsets[segment]))
+        return shape, dtype
 
     def __len__(self):
         return self._len
 
+    def _read(self, i):
+        datum_id = self._datum_id(i)
+        if not self._cache:
+            return retrieve(datum_id)
+        img = frame_cache.get(datum_id)
+        if img is None:
+            img = np.asarray(retrieve(datum_id))
+            # The same array is handed to every reader, so protect it.
+            img.flags.writeable = False
+            frame_cache[datum_id] = img
+        return img
+
+    def get_frames(self, key):
+        """
+        Read many frames into one array.
+
+        The frames are read with one lookup of their datums and one pass
+        over each file, straight into the result, which is allocated with
+        the shape and dtype of the first frame read. Frames already in the
+        frame cache are copied from it. The frames read are not added to
+        the cache.
+
+        Parameters
+        ----------
+        key : slice, sequence of ints, or boolean mask
+            which frames to read
+
+        Returns
+        -------
+        frames : ndarray
+            with shape (number of frames,) + frame_shape
+
+        Example
+        -------
+        >>> images.get_frames(slice(100, 600))
+        >>> images.get_frames([0, 5, -1])
+        >>> images.get_frames(mask)
+        """
+        indices = self._indices(key)
+        datum_ids = [self._datum_id(i) for i in indices]
+        shape, dtype = self._batch_metadata(indices)
+        if not indices:
+            return np.empty((0,) + tuple(shape), dtype=dtype)
+        cached = {}
+        if self._cache:
+            for row, datum_id in enumerate(datum_ids):
+                img = frame_cache.get(datum_id)
+                if img is not None:
+                    cached[row] = img
+        if not cached:
+            # The descriptor's dtype may be wrong, so let the first frame
+            # read decide.
+            return bulk_retrieve(datum_ids, stack=True)
+        first = next(iter(cached.values()))
+        out = np.empty((len(indices),) + first.shape, dtype=first.dtype)
+        for row, img in cached.items():
+            if img.dtype != out.dtype or img.shape != out.shape[1:]:
+                raise ValueError("Frame {0} has shape {1} and dtype {2}, "
+                                 "unlike the others.".format(
+                                     indices[row], img.shape, img.dtype))
+            out[row] = img
+        missing = [row for row in range(len(indices)) if row not in cached]
+        if missing:
+            # bulk_retrieve raises rather than cast into out.
+            out[missing] = bulk_retrieve([datum_ids[row] for row in missing],
+                                         out=np.empty_like(out[missing]))
+        return out
+
+    def _indices(self, key):
+        """
+        Normalize a slice, sequence of ints or boolean mask to a list of
+        frame numbers, all in range and not negative.
+        """
+        if isinstance(key, slice):
+            return list(range(*key.indices(self._len)))
+        key = np.asarray(key)
+        if key.size == 0:
+            return []
+        if key.dtype == bool:
+            if key.shape != (self._len,):
+                raise ValueError("A boolean mask must have one entry per "
+                                 "frame ({0}).".format(self._len))
+            return list(np.flatnonzero(key))
+        if key.ndim != 1 or key.dtype.kind not in 'iu':
+            raise ValueError("Frames must be selected by a slice, a "
+                             "sequence of integers or a boolean mask.")
+        return [self._frame_index(int(i)) for i in key]
+
+    @staticmethod
+    def cache_info():
+        "Report hits, misses, maxsize and currsize (bytes) of frame_cache."
+        return frame_cache.info()
+
     def get_frame(self, i):
-        img = retrieve(self._datum_uids[i])
+        i = self._frame_index(i)
+        if self._read_ahead is not None:
+            img = self._read_ahead.get(i)
+        else:
+            img = self._read(i)
+        if self._cache:
+            # Keep the cached array intact for the next reader.
+            img = np.array(img)
         return Frame(img, frame_no=i)
+
+
+class _ReadAhead(object):
+    """
+    Predict which frames will be wanted next and read them on threads.
+
+    Once two consecutive accesses are the same (nonzero) stride apart --
+    e.g., 4, 5, 6 or 9, 7, 5 -- the next depth frames along that stride are
+    read in the background. An access that breaks the pattern cancels the
+    reads that have not started and discards the rest.
+    """
+    def __init__(self, read, length, depth, max_workers):
+        self._read = read
+        self._length = length
+        self._depth = depth
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._futures = {}  # frame number -> Future
+        self._last = None
+        self._stride = None
+        self._lock = threading.Lock()
+
+    def get(self, i):
+        "Return frame i, from a read ahead if there is one."
+        with self._lock:
+            future = self._futures.pop(i, None)
+            stride = i - self._last if self._last is not None else None
+            if stride and stride == self._stride:
+                predicted = [j for j in (i + stride * k for k
+                                         in range(1, self._depth + 1))
+                             if 0 <= j < self._length]
+            else:
+                predicted = []
+            self._last, self._stride = i, stride
+            for j in list(self._futures):
+                if j not in predicted:
+                    self._futures.pop(j).cancel()
+            for j in predicted:
+                if j not in self._futures:
+                    self._futures[j] = self._executor.submit(
+                        propagate(self._read), j)
+        if future is not None:
+            try:
+                return future.result()
+            except CancelledError:
+                pass
+        return self._read(i)
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures.clear()
+        self._executor.shutdown(wait=False)
+
+
+def _numpy_dtype(dtype):
+    "Interpret a descriptor's dtype as a numpy dtype, or return None."
+    if dtype is None or dtype in _JSON_TYPES:
+        return None
+    try:
+        return np.dtype(dtype)
+    except TypeError:
+        return None
+
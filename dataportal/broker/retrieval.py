@@ -0,0 +1,286 @@
+"""Bulk and lazy retrieval of externally stored data from filestore.
+
+``filestore.api.retrieve`` looks up one datum at a time. When many datums
+are needed at once -- every frame of an area detector run, say -- it is much
+faster to look up all the datum documents in one query, group them by the
+resource (i.e., file) they point into, and read each resource in one pass.
+
+Conversely, when datums may never be needed, a LazyArray stands in for each
+one and reads it only on use.
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import OrderedDict
+import logging
+import numpy as np
+import six
+import filestore.api as fs
+from .stats import record, record_datum, timed
+
+try:
+    from filestore.odm_templates import Datum, Resource
+    from filestore.retrieve import get_spec_handler
+except ImportError:
+    # This version of filestore does not expose its datum documents, so
+    # bulk_retrieve falls back to retrieving datums one at a time, and
+    # LazyArray cannot memory-map.
+    Datum = None
+
+
+logger = logging.getLogger(__name__)
+
+
+def retrieve(datum_id):
+    """
+    Retrieve the data for one datum id, like filestore.api.retrieve.
+
+    The call is counted and timed by dataportal.broker.stats.
+    """
+    with timed('handler_time'):
+        data = fs.retrieve(datum_id)
+    record_datum(data)
+    return data
+
+
+def bulk_retrieve(datum_ids, stack=False, out=None):
+    """
+    Retrieve the data for many datum ids, reading each resource once.
+
+    Parameters
+    ----------
+    datum_ids : iterable
+        datum ids, as found in Events; repeats are retrieved only once
+    stack : bool, optional
+        If True, return the data as one array of shape (N,) + frame shape,
+        allocated when the first datum is read. Every datum must then have
+        the same shape and dtype. False by default.
+    out : ndarray, optional
+        Write the data into this array, whose first dimension must match
+        the number of datum ids and whose dtype must match the data's, and
+        return it. This implies stack.
+
+    Returns
+    -------
+    data : list or ndarray
+        the retrieved data (typically numpy arrays), in the same order as
+        datum_ids
+    """
+    datum_ids = list(datum_ids)
+    positions = OrderedDict()
+    for i, datum_id in enumerate(datum_ids):
+        positions.setdefault(datum_id, []).append(i)
+    if stack or out is not None:
+        sink = _ArraySink(positions, len(datum_ids), out)
+    else:
+        sink = _ListSink(positions, len(datum_ids))
+
+    if Datum is None:
+        for datum_id in positions:
+            sink.store(datum_id, retrieve(datum_id))
+    else:
+        _retrieve_grouped(list(positions), sink.store)
+    return sink.result
+
+
+class _ListSink(object):
+    "Collect retrieved data in a list."
+    def __init__(self, positions, length):
+        self._positions = positions
+        self.result = [None] * length
+
+    def store(self, datum_id, data):
+        for i in self._positions[datum_id]:
+            self.result[i] = data
+
+
+class _ArraySink(object):
+    """
+    Copy retrieved data into one array as soon as it is read, so that no
+    more than one datum is held in memory besides the output.
+    """
+    def __init__(self, positions, length, out=None):
+        if out is not None and len(out) != length:
+            raise ValueError("out has room for {0} datums but {1} were "
+                             "requested".format(len(out), length))
+        self._positions = positions
+        self._length = length
+        self._out = out
+
+    @property
+    def result(self):
+        if self._out is None:
+            # No datums were requested, so the frame shape is unknown.
+            return np.empty((0,))
+        return self._out
+
+    def store(self, datum_id, data):
+        data = np.asarray(data)
+        if self._out is None:
+            self._out = np.empty((self._length,) + data.shape,
+                                 dtype=data.dtype)
+        elif data.shape != self._out.shape[1:]:
+            raise ValueError("Datum {0} has shape {1}, which does not "
+                             "match {2}".format(datum_id, data.shape,
+                                                self._out.shape[1:]))
+        elif data.dtype != self._out.dtype:
+            # Assigning would cast silently, e.g. truncating floats.
+            raise ValueError("Datum {0} has dtype {1}, which does not "
+                             "match {2}".format(datum_id, data.dtype,
+                                                self._out.dtype))
+        for i in self._positions[datum_id]:
+            self._out[i] = data
+
+
+def _retrieve_grouped(datum_ids, store):
+    "Retrieve datums grouped by resource, passing each to store."
+    if not datum_ids:
+        return
+    col = Datum._get_collection()
+    datums = {}
+    record('queries')
+    with timed('query_time'):
+        for datum in col.find({'datum_id': {'$in': datum_ids}}):
+            datums[datum['datum_id']] = datum
+    record('documents', len(datums))
+    missing = [datum_id for datum_id in datum_ids if datum_id not in datums]
+    if missing:
+        raise ValueError("No datum found with id {0}".format(missing[0]))
+
+    by_resource = OrderedDict()
+    for datum_id in datum_ids:
+        datum = datums[datum_id]
+        by_resource.setdefault(datum['resource'], []).append(datum)
+
+    for resource, group in six.iteritems(by_resource):
+        logger.debug("Reading %d datums from resource %s", len(group),
+                     resource)
+        # Looking up the handler queries for the resource and opens it.
+        record('queries')
+        with timed('handler_time'):
+            handler = get_spec_handler(resource)
+        # Handlers typically address datums by position within the file,
+        # so visiting them in order of their kwargs reads sequentially.
+        try:
+            group.sort(key=lambda d: sorted(d['datum_kwargs'].items()))
+        except TypeError:
+            pass  # not orderable; read in the order requested
+        for datum in group:
+            with timed('handler_time'):
+                data = handler(**datum['datum_kwargs'])
+            record_datum(data)
+            store(datum['datum_id'], data)
+
+
+class LazyArray(object):
+    """
+    A placeholder for externally stored data that is read on first use.
+
+    Indexing a LazyArray, or converting it with numpy.asarray, reads the
+    data. Where the file format allows (e.g., 'npy' resources), the file is
+    memory-mapped, so that indexing reads only the requested part, and the
+    map is kept for later use. Otherwise the data is read through
+    filestore every time it is used, so that holding many LazyArrays
+    costs little memory; the resource is only looked up once to find that
+    it cannot be mapped.
+
+    Parameters
+    ----------
+    datum_id : str
+    shape : tuple, optional
+        the shape, if known (e.g., from the EventDescriptor). Once the data
+        has been read or mapped, its actual shape is reported instead.
+    dtype : numpy.dtype, optional
+        the dtype, if known
+    """
+    def __init__(self, datum_id, shape=None, dtype=None):
+        self.datum_id = datum_id
+        self._shape = tuple(shape) if shape is not None else None
+        self._dtype = np.dtype(dtype) if dtype is not None else None
+        self._mmap = None
+        self._mappable = True  # until _memory_map says otherwise
+
+    def _source(self):
+        "Return a memory map of the data if possible, else read it."
+        if self._mmap is not None:
+            return self._mmap
+        if self._mappable:
+            mapped = _memory_map(self.datum_id)
+            if mapped is not None:
+                self._mmap = mapped
+                self._shape, self._dtype = mapped.shape, mapped.dtype
+                return mapped
+            self._mappable = False
+        data = np.asarray(retrieve(self.datum_id))
+        self._shape, self._dtype = data.shape, data.dtype
+        return data
+
+    @property
+    def shape(self):
+        if self._shape is None:
+            self._source()
+        return self._shape
+
+    @property
+    def dtype(self):
+        if self._dtype is None:
+            self._source()
+        return self._dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self._source()[key]
+
+    def __array__(self, dtype=None):
+        data = np.asarray(self._source())
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+        return data
+
+    def read(self):
+        "Read all of the data into a new ndarray."
+        return np.array(self._source())
+
+    def __repr__(self):
+        return "<LazyArray {0} shape={1}>".format(self.datum_id, self._shape)
+
+
+def _read_npy_lazily(resource_path, resource_kwargs, datum_kwargs):
+    return np.load(resource_path, mmap_mode='r')
+
+
+# Readers for resource specs whose files can be memory-mapped, keyed by spec.
+# Each takes the resource path, the resource kwargs and the datum kwargs.
+lazy_readers = {'npy': _read_npy_lazily}
+
+
+def _memory_map(datum_id):
+    "Memory-map a datum if its resource spec allows it; else return None."
+    if Datum is None:
+        return None
+    record('queries', 2)
+    with timed('query_time'):
+        datum = Datum._get_collection().find_one({'datum_id': datum_id})
+        if datum is None:
+            return None
+        resource = Resource._get_collection().find_one(
+            {'_id': datum['resource']})
+    if resource is None or resource['spec'] not in lazy_readers:
+        return None
+    reader = lazy_readers[resource['spec']]
+    try:
+        return reader(resource['resource_path'],
+                      resource.get('resource_kwargs', {}),
+                      datum.get('datum_kwargs', {}))
+    except (IOError, OSError, ValueError) as err:
+        logger.debug("Could not memory-map datum %s: %s", datum_id, err)
+        return None
@@ -0,0 +1,350 @@
+"""A local, read-only data service shared by many analysis processes.
+
+One DataServer process answers header lookups, tables and frames over HTTP
+on localhost. Its header, descriptor, table and frame caches are shared by
+every client, so many notebooks viewing the same run cost one retrieval.
+Clients use RemoteDataBroker, which mimics DataBroker and get_table.
+
+Nothing is pickled: headers travel as JSON, tables as .npz and frames as
+.npy, both loaded with allow_pickle=False.
+
+Example
+-------
+Start the server (or run ``python -m dataportal.broker.server``):
+
+>>> server = DataServer(port=8765)
+>>> server.start()  # in a background thread
+
+In each client:
+
+>>> db = RemoteDataBroker('http://127.0.0.1:8765')
+>>> header = db[-1]
+>>> table = db.get_table(header)
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import OrderedDict
+from io import BytesIO
+import argparse
+import json
+import logging
+import threading
+import numpy as np
+import pandas as pd
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.parse import urlencode, urlparse, parse_qsl
+from six.moves.urllib.request import urlopen
+import metadatastore.doc as doc
+from .cache import LRUCache
+from .simple_broker import (DataBroker, Header, get_table, stacked_array,
+                            _header_list, _column, _assemble_table)
+from .retrieval import retrieve
+
+
+logger = logging.getLogger(__name__)
+
+
+class DataServer(object):
+    """
+    Serve headers, tables and frames to local clients over HTTP.
+
+    Parameters
+    ----------
+    host : str, optional
+        address to bind; '127.0.0.1' by default, so that only this machine
+        can connect
+    port : int, optional
+        0 by default, meaning any free port (see the url attribute)
+    table_cache_bytes : int, optional
+        the most bytes of encoded tables to keep in memory; 1 GiB by default
+    frame_cache_bytes : int, optional
+        the most bytes of encoded frames to keep in memory; 1 GiB by default
+    """
+    def __init__(self, host='127.0.0.1', port=0, table_cache_bytes=2**30,
+                 frame_cache_bytes=2**30):
+        self.table_cache = LRUCache(maxsize=table_cache_bytes, getsizeof=len)
+        self.frame_cache = LRUCache(maxsize=frame_cache_bytes, getsizeof=len)
+        self._httpd = _ThreadingHTTPServer((host, port), _RequestHandler)
+        self._httpd.data_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{0}:{1}'.format(host, port)
+
+    def serve_forever(self):
+        "Handle requests until shutdown() is called."
+        logger.info("Serving data at %s", self.url)
+        self._httpd.serve_forever()
+
+    def start(self):
+        "Handle requests on a background (daemon) thread."
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        "Stop handling requests and release the port."
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def header(self, params):
+        key = _decode_key(json.loads(params['key']))
+        headers = DataBroker[key]
+        return _encode_json(_header_to_json(headers)), 'application/json'
+
+    def search(self, params):
+        headers = DataBroker(**json.loads(params.get('query', '{}')))
+        return _encode_json(_header_to_json(headers)), 'application/json'
+
+    def table(self, params):
+        uids = json.loads(params['uids'])
+        fields = json.loads(params.get('fields', 'null'))
+        fill = json.loads(params.get('fill', 'true'))
+        if fill == 'lazy':
+            raise ValueError("fill='lazy' is not supported over the "
+                             "server; use fill=True or fill=False.")
+        key = (tuple(uids), tuple(sorted(fields)) if fields else None, fill)
+        body = self.table_cache.get(key)
+        if body is None:
+            headers = DataBroker[uids] if uids else []
+            table = get_table(headers, fields, fill=fill,
+                              convert_times=False, stack_arrays=True)
+            body = _encode_table(table)
+            # The tables of open runs may still grow.
+            if all(header['stop'] is not None for header in headers):
+                self.table_cache[key] = body
+        return body, 'application/octet-stream'
+
+    def frame(self, params):
+        datum_id = params['datum_id']
+        body = self.frame_cache.get(datum_id)
+        if body is None:
+            buf = BytesIO()
+            np.save(buf, np.asarray(retrieve(datum_id)))
+            body = buf.getvalue()
+            self.frame_cache[datum_id] = body
+        return body, 'application/octet-stream'
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    routes = {'/header': 'header', '/search': 'search', '/table': 'table',
+              '/frame': 'frame'}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        route = self.routes.get(url.path)
+        if route is None:
+            self.send_error(404, "No such endpoint: {0}".format(url.path))
+            return
+        params = dict(parse_qsl(url.query))
+        try:
+            body, content_type = getattr(self.server.data_server,
+                                         route)(params)
+        except (ValueError, KeyError, IndexError) as err:
+            self._send(400, _encode_json({'error': str(err)}),
+                       'application/json')
+            return
+        self._send(200, body, content_type)
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class RemoteDataBroker(object):
+    """
+    A stand-in for DataBroker that asks a DataServer.
+
+    Parameters
+    ----------
+    url : str
+        e.g., 'http://127.0.0.1:8765'
+    timeout : float, optional
+        seconds to wait for each response; 60 by default
+    """
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _get(self, endpoint, **params):
+        url = '{0}/{1}?{2}'.format(self.url, endpoint, urlencode(params))
+        try:
+            response = urlopen(url, timeout=self.timeout)
+        except HTTPError as err:
+            try:
+                message = json.loads(err.read().decode('utf-8'))['error']
+            except (ValueError, KeyError):
+                raise err
+            raise ValueError(message)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def __getitem__(self, key):
+        "DWIM slicing; see DataBroker.__getitem__."
+        body = self._get('header', key=json.dumps(_encode_key(key)))
+        return _header_from_json(json.loads(body.decode('utf-8')))
+
+    def __call__(self, **kwargs):
+        "Find Headers; see DataBroker.__call__."
+        body = self._get('search', query=json.dumps(kwargs))
+        return _header_from_json(json.loads(body.decode('utf-8')))
+
+    def get_table(self, headers, fields=None, fill=True, convert_times=True):
+        """
+        Make a table (pandas.DataFrame) from given run(s).
+
+        See dataportal.broker.get_table. Filled array columns hold views of
+        one block per column, which stacked_array recovers without copying.
+        """
+        uids = [header['start']['uid'] for header in _header_list(headers)]
+        body = self._get('table', uids=json.dumps(uids),
+                         fields=json.dumps(fields), fill=json.dumps(fill))
+        index, columns = _decode_table(body)
+        if 'time' not in columns:
+            # edge case: no data
+            return pd.DataFrame()
+        for name, values in six.iteritems(columns):
+            columns[name] = _column(values)
+        return _assemble_table(index, columns, convert_times)
+
+    def retrieve(self, datum_id):
+        "Retrieve one datum, like filestore.api.retrieve."
+        body = self._get('frame', datum_id=datum_id)
+        return np.load(BytesIO(body), allow_pickle=False)
+
+
+def _encode_key(key):
+    "Encode a DataBroker[...] key as JSON-able data."
+    if isinstance(key, slice):
+        return {'slice': [key.start, key.stop, key.step]}
+    if isinstance(key, (int, six.string_types)):
+        return key
+    return [_encode_key(k) for k in key]
+
+
+def _decode_key(key):
+    if isinstance(key, dict):
+        return slice(*key['slice'])
+    if isinstance(key, list):
+        return [_decode_key(k) for k in key]
+    return key
+
+
+def _header_to_json(headers):
+    "Convert a Header, or a list of them, to plain data."
+    if isinstance(headers, Header):
+        return {'start': dict(headers['start']),
+                'stop': (dict(headers['stop']) if headers['stop'] is not None
+                         else None),
+                'descriptors': [dict(d) for d in headers['descriptors']]}
+    return [_header_to_json(header) for header in headers]
+
+
+def _header_from_json(data):
+    if isinstance(data, list):
+        return [_header_from_json(d) for d in data]
+    stop = data['stop']
+    d = {'start': doc.Document('RunStart', data['start']),
+         'stop': doc.Document('RunStop', stop) if stop is not None else None,
+         'descriptors': [doc.Document('EventDescriptor', desc)
+                         for desc in data['descriptors']]}
+    return Header('header', d)
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)  # e.g., ObjectId, datetime
+
+
+def _encode_json(data):
+    return json.dumps(data, default=_json_default).encode('utf-8')
+
+
+def _encode_table(table):
+    """
+    Encode a DataFrame as .npz without pickling.
+
+    A column of Python objects (e.g., filled arrays) is sent as one block
+    stacking its non-null rows, plus a boolean mask of which rows those
+    are. Rows are null where a field is missing from some descriptors.
+    """
+    arrays = {'index': np.asarray(table.index),
+              'names': np.array([six.text_type(c) for c in table.columns])}
+    for i, name in enumerate(table.columns):
+        values = table[name].values
+        if values.dtype.hasobject:
+            mask = np.array([not _is_null(v) for v in values], dtype=bool)
+            values = stacked_array(values[mask])
+            if values.dtype.hasobject:
+                raise ValueError("The column {0!r} cannot be sent without "
+                                 "pickling.".format(name))
+            if not mask.all():
+                arrays['mask{0}'.format(i)] = mask
+        arrays['col{0}'.format(i)] = values
+    buf = BytesIO()
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def _is_null(value):
+    return value is None or (np.isscalar(value) and value != value)
+
+
+def _decode_table(body):
+    "Return the index and an OrderedDict of columns from .npz bytes."
+    with np.load(BytesIO(body), allow_pickle=False) as npz:
+        names = list(npz['names'])
+        columns = OrderedDict()
+        for i, name in enumerate(names):
+            values = npz['col{0}'.format(i)]
+            mask_name = 'mask{0}'.format(i)
+            if mask_name in npz.files:
+                # Put the rows of the block back in place, with NaN between.
+                column = np.empty(len(npz[mask_name]), dtype=object)
+                column[:] = np.nan
+                for row, value in zip(np.flatnonzero(npz[mask_name]),
+                                      values):
+                    column[row] = value
+                values = column
+            columns[name] = values
+        return npz['index'], columns
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve dataportal data to local clients.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    server = DataServer(host=args.host, port=args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
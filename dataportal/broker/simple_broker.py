@@ -1,27 +1,100 @@
 from __future__ import print_function
 import warnings
 import six  # noqa
-from collections import Iterable, deque
+import itertools
+import heapq
+import threading
+import re
+from collections import Iterable, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import tzlocal
 from metadatastore.commands import (find_last, find_run_starts,
-                                    find_descriptors,
+                                    find_descriptors, find_events,
                                     get_events_generator, get_events_table)
 import metadatastore.doc as doc
 import metadatastore.commands as mc
-import filestore.api as fs
+from .cache import LRUCache, descriptor_info
+from .explain import explain_search, _run_start_ids, _run_start_in
+from .indexes import DataKeyIndex, UidPrefixIndex
+from .retrieval import LazyArray, bulk_retrieve, retrieve
+from .stats import instrument_query, propagate, timed
 import logging
 
+try:
+    from metadatastore.odm_templates import Event, EventDescriptor
+except ImportError:
+    # This version of metadatastore does not expose its collections, so
+    # Events can only be read whole, through metadatastore.commands.
+    Event = EventDescriptor = None
+
 
 logger = logging.getLogger(__name__)
 TZ = str(tzlocal.get_localzone())
 
+# Every query goes through these, so that it can be counted and timed.
+find_last = instrument_query(find_last)
+find_run_starts = instrument_query(find_run_starts)
+find_descriptors = instrument_query(find_descriptors)
+find_events = instrument_query(find_events)
+find_run_stops = instrument_query(mc.find_run_stops)
+run_start_given_uid = instrument_query(mc.run_start_given_uid)
+stop_by_start = instrument_query(mc.stop_by_start)
+descriptors_by_start = instrument_query(mc.descriptors_by_start)
+get_events_generator = instrument_query(get_events_generator)
+get_events_table = instrument_query(
+    get_events_table, count_documents=lambda payload: len(payload[2]))
+_run_start_ids = instrument_query(
+    _run_start_ids, count_documents=lambda ids: len(ids or ()))
+
+
+def _event_query(descriptor):
+    "Select the Events of a descriptor in the Event collection."
+    oid = descriptor.get('_id')
+    if oid is None:
+        col = EventDescriptor._get_collection()
+        oid = col.find_one({'uid': descriptor['uid']}, {'_id': 1})['_id']
+    return {'descriptor_id': oid}
+
+
+def _count_events(descriptor):
+    "Count the Events of a descriptor without fetching them."
+    col = Event._get_collection()
+    query = _event_query(descriptor)
+    if hasattr(col, 'count_documents'):
+        return col.count_documents(query)
+    return col.find(query).count()
+
+
+def _find_raw_events(descriptor, projection=None, criteria=None, sort=None,
+                     skip=0, limit=0):
+    """
+    Yield the raw documents of a descriptor's Events that match criteria
+    from the Event collection, with only the fields in projection.
+    """
+    query = _event_query(descriptor)
+    if criteria:
+        query.update(criteria)
+    cursor = Event._get_collection().find(query, projection)
+    if sort is not None:
+        cursor = cursor.sort(sort)
+    return iter(cursor.skip(skip).limit(limit))
+
+_count_events = instrument_query(_count_events,
+                                 count_documents=lambda count: 0)
+_find_raw_events = instrument_query(_find_raw_events)
+
 
 class _DataBrokerClass(object):
     # A singleton is instantiated in broker/__init__.py.
     # You probably do not want to instantiate this; use
     # broker.DataBroker instead.
 
+    def __init__(self):
+        self._data_key_index = DataKeyIndex()
+        self._uid_index = UidPrefixIndex()
+
     def __getitem__(self, key):
         """DWIM slicing
 
@@ -44,8 +117,31 @@ class _DataBrokerClass(object):
                                  "the result could become too large.")
             start = -key.start
             result = list(find_last(start))[stop::key.step]
-            header = [Header.from_run_start(h) for h in result]
-        elif isinstance(key, int):
+            self._uid_index.update(rs['uid'] for rs in result)
+            header = Header.from_run_starts(result, lazy=True)
+        elif isinstance(key, (int, six.string_types)):
+            header = Header.from_run_start(self._lookup_run_start(key),
+                                           lazy=True)
+        elif isinstance(key, Iterable):
+            # Interpret key as a list of several keys. If it is a string
+            # we will never get this far.
+            key = list(key)
+            if all(isinstance(k, (int, six.string_types)) for k in key):
+                # Resolve each key to a RunStart, then build all the
+                # Headers together.
+                run_starts = [self._lookup_run_start(k) for k in key]
+                return Header.from_run_starts(run_starts, lazy=True)
+            return [self.__getitem__(k) for k in key]
+        else:
+            raise ValueError("Must give an integer scan ID like [6], a slice "
+                             "into past scans like [-5], [-5:], or [-5:-9:2], "
+                             "a list like [1, 7, 13], or a (partial) uid "
+                             "like ['a23jslk'].")
+        return header
+
+    def _lookup_run_start(self, key):
+        "Find the RunStart Document referred to by an int or string key."
+        if isinstance(key, int):
             if key > -1:
                 # Interpret key as a scan_id.
                 gen = find_run_starts(scan_id=key)
@@ -53,7 +149,6 @@ class _DataBrokerClass(object):
                     result = next(gen)  # most recent match
                 except StopIteration:
                     raise ValueError("No such run found.")
-                header = Header.from_run_start(result)
             else:
                 # Interpret key as the Nth last scan.
                 gen = find_last(-key)
@@ -63,32 +158,31 @@ class _DataBrokerClass(object):
                     except StopIteration:
                         raise IndexError(
                             "There are only {0} runs.".format(i))
-                header = Header.from_run_start(result)
-        elif isinstance(key, six.string_types):
+        else:
             # Interpret key as a uid (or the few several characters of one).
             # First try searching as if we have the full uid.
             results = list(find_run_starts(uid=key))
             if len(results) == 0:
-                # No dice? Try searching as if we have a partial uid.
-                gen = find_run_starts(uid={'$regex': '{0}.*'.format(key)})
-                results = list(gen)
+                # No dice? It is a partial uid. If we already know of two
+                # runs that match, it is ambiguous.
+                if len(self._uid_index.matches(key, limit=2)) > 1:
+                    raise ValueError("That partial uid matches multiple "
+                                     "runs. Provide more characters.")
+                # Otherwise, the anchored regex can be answered from the
+                # index on uid, and two matches are enough to know that the
+                # prefix is ambiguous.
+                pattern = '^{0}'.format(re.escape(key))
+                gen = find_run_starts(uid={'$regex': pattern})
+                results = list(itertools.islice(gen, 2))
             if len(results) < 1:
                 raise ValueError("No such run found.")
             if len(results) > 1:
+                self._uid_index.update(rs['uid'] for rs in results)
                 raise ValueError("That partial uid matches multiple runs. "
                                  "Provide more characters.")
             result, = results
-            header = Header.from_run_start(result)
-        elif isinstance(key, Iterable):
-            # Interpret key as a list of several keys. If it is a string
-            # we will never get this far.
-            return [self.__getitem__(k) for k in key]
-        else:
-            raise ValueError("Must give an integer scan ID like [6], a slice "
-                             "into past scans like [-5], [-5:], or [-5:-9:2], "
-                             "a list like [1, 7, 13], or a (partial) uid "
-                             "like ['a23jslk'].")
-        return header
+        self._uid_index.add(result['uid'])
+        return result
 
     def __call__(self, **kwargs):
         """Given search criteria, find Headers describing runs.
@@ -139,29 +233,62 @@ class _DataBrokerClass(object):
         data_key = kwargs.pop('data_key', None)
         run_start = find_run_starts(**kwargs)
         if data_key is not None:
-            node_name = 'data_keys.{0}'.format(data_key)
-
-            query = {node_name: {'$exists': True}}
-            descriptors = []
-            for rs in run_start:
-                descriptor = find_descriptors(run_start=rs, **query)
-                for d in descriptor:
-                    descriptors.append(d)
-            # query = {node_name: {'$exists': True},
-            #          'run_start_id': {'$in': [ObjectId(rs.id) for rs in run_start]}}
-            # descriptors = find_descriptors(**query)
-            result = []
-            known_uids = deque()
-            for descriptor in descriptors:
-                if descriptor['run_start']['uid'] not in known_uids:
-                    rs = descriptor['run_start']
-                    known_uids.append(rs['uid'])
-                    result.append(rs)
-            run_start = result
-        result = []
-        for rs in run_start:
-            result.append(Header.from_run_start(rs))
-        return result
+            run_start = list(run_start)
+            self._index_data_keys(run_start)
+            matches = self._data_key_index.runs_with(data_key)
+            run_start = [rs for rs in run_start if rs['uid'] in matches]
+        run_start = list(run_start)
+        self._uid_index.update(rs['uid'] for rs in run_start)
+        return Header.from_run_starts(run_start, lazy=True)
+
+    def explain(self, estimate=True, **kwargs):
+        """Describe the queries that DataBroker(**kwargs) would issue.
+
+        Nothing is fetched except, if estimate is True, document counts and
+        (for data_key searches) the uids of the matching runs.
+
+        Parameters
+        ----------
+        estimate : bool, optional
+            Whether to ask the database how many documents each query would
+            match. True by default.
+        **kwargs
+            search criteria, as for DataBroker(...)
+
+        Returns
+        -------
+        plan : list
+            QueryPlan namedtuples with the fields collection, query, sort,
+            count, index and notes, one per query, in order
+
+        Examples
+        --------
+        >>> for query in DataBroker.explain(data_key='motor1'):
+        ...     print(query.collection, query.count, query.index)
+        """
+        return explain_search(kwargs, self._data_key_index,
+                              estimate=estimate)
+
+    def _index_data_keys(self, run_starts):
+        """
+        Bring the data key index up to date for the given runs.
+
+        Runs that are already completely indexed cost nothing. All the others
+        are indexed together using one query for RunStops and one for
+        EventDescriptors.
+        """
+        uids = self._data_key_index.unindexed(rs['uid'] for rs in run_starts)
+        if not uids:
+            return
+        stopped = set(mc.doc_or_uid_to_uid(run_stop['run_start']) for run_stop
+                      in _find_by_run_starts(find_run_stops, uids))
+        data_keys = {uid: set() for uid in uids}
+        for descriptor in _find_by_run_starts(find_descriptors, uids):
+            uid = mc.doc_or_uid_to_uid(descriptor['run_start'])
+            data_keys[uid].update(descriptor['data_keys'])
+        for uid, keys in six.iteritems(data_keys):
+            self._data_key_index.add(uid, keys, complete=uid in stopped)
+        logger.debug("Indexed the data keys of %d runs", len(uids))
 
     def find_headers(self, **kwargs):
         "This function is deprecated. Use DataBroker() instead."
@@ -179,35 +306,33 @@ class _DataBrokerClass(object):
 DataBroker = _DataBrokerClass()  # singleton, used by pims_readers import below
 
 
-def _inspect_descriptor(descriptor):
-    """
-    Return a dict with the data keys mapped to boolean answering whether
-    data is external.
-    """
-    # TODO memoize to cache these results
-    data_keys = descriptor.data_keys
-    is_external = dict()
-    for data_key, data_key_dict in data_keys.items():
-        is_external[data_key] = data_key_dict.get('external', False)
-    return is_external
-
-
-def fill_event(event):
+def fill_event(event, lazy=False):
     """
     Populate events with externally stored data.
+
+    Parameters
+    ----------
+    event : Event
+    lazy : bool, optional
+        If True, insert a LazyArray for each datum, which reads it only when
+        used, instead of reading it now. False by default.
     """
-    is_external = _inspect_descriptor(event.descriptor)
-    for data_key, value in six.iteritems(event.data):
-        if is_external[data_key]:
-            # Retrieve a numpy array from filestore
-            event.data[data_key] = fs.retrieve(value)
+    info = descriptor_info(event.descriptor)
+    for data_key in info.external_keys:
+        if data_key in event.data:
+            if lazy:
+                event.data[data_key] = LazyArray(event.data[data_key],
+                                                 shape=info.shapes[data_key])
+            else:
+                # Retrieve a numpy array from filestore
+                event.data[data_key] = retrieve(event.data[data_key])
 
 
 class Header(doc.Document):
     """A dictionary-like object summarizing metadata for a run."""
 
     @classmethod
-    def from_run_start(cls, run_start, verify_integrity=False):
+    def from_run_start(cls, run_start, verify_integrity=False, lazy=False):
         """
         Build a Header from a RunStart Document.
 
@@ -215,16 +340,25 @@ class Header(doc.Document):
         ----------
         run_start : metadatastore.document.Document or str
             RunStart Document or uid
+        lazy : bool, optional
+            If True, look up the RunStop and EventDescriptors only when
+            they are first accessed. False by default.
 
         Returns
         -------
         header : dataportal.broker.Header
         """
+        if lazy:
+            header, = cls.from_run_starts([run_start], lazy=True)
+            return header
         run_start_uid = mc.doc_or_uid_to_uid(run_start)
-        run_start = mc.run_start_given_uid(run_start_uid)
+        header = header_cache.get(run_start_uid)
+        if header is not None:
+            return header
+        run_start = run_start_given_uid(run_start_uid)
 
         try:
-            run_stop = doc.ref_doc_to_uid(mc.stop_by_start(run_start_uid),
+            run_stop = doc.ref_doc_to_uid(stop_by_start(run_start_uid),
                                           'run_start')
         except mc.NoRunStop:
             run_stop = None
@@ -232,15 +366,249 @@ class Header(doc.Document):
         try:
             ev_descs = [doc.ref_doc_to_uid(ev_desc, 'run_start')
                         for ev_desc in
-                        mc.descriptors_by_start(run_start_uid)]
+                        descriptors_by_start(run_start_uid)]
         except mc.NoEventDescriptors:
             ev_descs = []
 
         d = {'start': run_start, 'stop': run_stop, 'descriptors': ev_descs}
-        return cls('header', d)
+        header = cls('header', d)
+        if run_stop is not None:
+            header_cache[run_start_uid] = header
+        return header
+
+    @classmethod
+    def from_run_starts(cls, run_starts, lazy=False):
+        """
+        Build Headers for several runs using a fixed number of queries.
+
+        The RunStops and EventDescriptors of all the runs are fetched in
+        bulk, rather than with one round trip per document per run.
+
+        Parameters
+        ----------
+        run_starts : iterable of metadatastore.document.Document or str
+            RunStart Documents or uids
+        lazy : bool, optional
+            If True, look up the RunStops and EventDescriptors only when one
+            of the Headers first needs them, and then for all of the Headers
+            at once. False by default.
+
+        Returns
+        -------
+        headers : list of dataportal.broker.Header
+            in the same order as run_starts
+        """
+        run_starts = list(run_starts)
+        uids = [mc.doc_or_uid_to_uid(rs) for rs in run_starts]
+        if not uids:
+            return []
+        unique_uids = list(set(uids))
+        headers = {}
+        for uid in unique_uids:
+            header = header_cache.get(uid)
+            if header is not None:
+                headers[uid] = header
+        stale_uids = [uid for uid in unique_uids if uid not in headers]
 
+        if stale_uids:
+            # RunStart Documents that we were handed can be used as they
+            # are; only bare uids need to be looked up.
+            starts = {rs['uid']: rs for rs in run_starts
+                      if not isinstance(rs, six.string_types)}
+            missing = [uid for uid in stale_uids if uid not in starts]
+            if missing:
+                for rs in find_run_starts(uid={'$in': missing}):
+                    starts[rs['uid']] = rs
+            for uid in stale_uids:
+                if uid not in starts:
+                    raise ValueError("No such run found: {0}".format(uid))
 
-def get_events(headers, fields=None, fill=True):
+            if lazy:
+                batch = _HeaderBatch()
+                for uid in stale_uids:
+                    headers[uid] = _LazyHeader('header',
+                                               {'start': starts[uid]})
+                    batch.add(headers[uid])
+            else:
+                stops, ev_descs = _stops_and_descriptors(stale_uids)
+                for uid in stale_uids:
+                    d = {'start': starts[uid], 'stop': stops.get(uid),
+                         'descriptors': ev_descs[uid]}
+                    headers[uid] = cls('header', d)
+                    if d['stop'] is not None:
+                        header_cache[uid] = headers[uid]
+
+        return [headers[uid] for uid in uids]
+
+
+def _stops_and_descriptors(run_start_uids):
+    """
+    Look up the RunStops and EventDescriptors of several runs in bulk.
+
+    Returns
+    -------
+    stops : dict
+        mapping RunStart uid to RunStop, for the runs that have one
+    ev_descs : dict
+        mapping RunStart uid to a list of EventDescriptors
+    """
+    stops = {}
+    for run_stop in _find_by_run_starts(find_run_stops, run_start_uids):
+        stops[mc.doc_or_uid_to_uid(run_stop['run_start'])] = \
+            doc.ref_doc_to_uid(run_stop, 'run_start')
+
+    ev_descs = {uid: [] for uid in run_start_uids}
+    for ev_desc in _find_by_run_starts(find_descriptors, run_start_uids):
+        uid = mc.doc_or_uid_to_uid(ev_desc['run_start'])
+        ev_descs[uid].append(doc.ref_doc_to_uid(ev_desc, 'run_start'))
+    return stops, ev_descs
+
+
+def _find_by_run_starts(find, run_start_uids):
+    """
+    Yield the documents found by find (e.g., find_descriptors) that refer to
+    any of several runs.
+
+    With access to the collections, this is one query for the ObjectIds of
+    the RunStarts and one for the documents. Otherwise each run is looked up
+    in turn.
+    """
+    run_start_uids = list(run_start_uids)
+    ids = _run_start_ids(run_start_uids)
+    if ids is None:
+        for uid in run_start_uids:
+            for document in find(run_start=uid):
+                yield document
+        return
+    if ids:
+        for document in find(**_run_start_in(ids.values())):
+            yield document
+
+
+class _LazyHeader(Header):
+    """
+    A Header that looks up its RunStop and EventDescriptors on first use.
+
+    It holds the RunStart from the start. Anything that needs the other
+    entries -- indexing them, iterating, comparing, printing -- resolves the
+    Header (and every other Header in its batch) first.
+    """
+    def __init__(self, name, d):
+        super(_LazyHeader, self).__init__(name, d)
+        # Document.__setattr__ sets items, so bypass it for internal state.
+        object.__setattr__(self, '_batch', None)
+
+    def _resolve(self):
+        batch = self._batch
+        if batch is not None:
+            batch.resolve()
+
+    def _set_resolved(self, run_stop, ev_descs):
+        dict.__setitem__(self, 'stop', run_stop)
+        dict.__setitem__(self, 'descriptors', ev_descs)
+        object.__setattr__(self, '_batch', None)
+
+    def __missing__(self, key):
+        if key in ('stop', 'descriptors') and self._batch is not None:
+            self._resolve()
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __reduce__(self):
+        self._resolve()
+        return (Header, (getattr(self, '_name', 'header'), dict(self)))
+
+
+def _resolving(method):
+    def wrapper(self, *args, **kwargs):
+        self._resolve()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+def _resolving_both(method):
+    "Like _resolving, for comparisons, which need the other side too."
+    def wrapper(self, other):
+        self._resolve()
+        if isinstance(other, _LazyHeader):
+            other._resolve()
+        return method(self, other)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+
+# Every dict-like accessor other than item lookup (which is handled by
+# __missing__) needs the full contents.
+for _name in ('__eq__', '__ne__'):
+    setattr(_LazyHeader, _name, _resolving_both(getattr(Header, _name)))
+for _name in ('__contains__', '__iter__', '__len__',
+              '__repr__', '__str__', '_repr_html_', 'keys', 'values',
+              'items', 'get', 'copy', 'to_name_dict_pair', 'iterkeys',
+              'itervalues', 'iteritems', 'has_key'):
+    if hasattr(Header, _name):
+        setattr(_LazyHeader, _name, _resolving(getattr(Header, _name)))
+del _name
+
+
+class _HeaderBatch(object):
+    """
+    Lazy Headers built together; they are resolved together, in bulk.
+    """
+    def __init__(self):
+        self._headers = []
+        self._lock = threading.Lock()
+
+    def add(self, header):
+        self._headers.append(header)
+        object.__setattr__(header, '_batch', self)
+
+    def resolve(self):
+        with self._lock:
+            headers, self._headers = self._headers, []
+            if not headers:
+                return  # Another thread got here first.
+            uids = [dict.__getitem__(h, 'start')['uid'] for h in headers]
+            try:
+                stops, ev_descs = _stops_and_descriptors(uids)
+            except Exception:
+                self._headers = headers  # Let a later access try again.
+                raise
+            for uid, header in zip(uids, headers):
+                header._set_resolved(stops.get(uid), ev_descs[uid])
+                if stops.get(uid) is not None:
+                    header_cache[uid] = header
+
+
+# In-process caches of Headers and of the EventDescriptors returned by
+# metadatastore, keyed by RunStart uid. A run that has a RunStop can never
+# change, so only stopped runs are cached and their entries are reused as
+# they are. Runs that are still open are looked up afresh every time.
+# Adjust the maxsize attribute of either cache to trade memory for speed.
+header_cache = LRUCache(maxsize=1000)
+descriptor_cache = LRUCache(maxsize=1000)
+
+
+def _header_descriptors(header):
+    """
+    Return the EventDescriptors of a run, from cache if the run has stopped.
+    """
+    run_start_uid = header['start']['uid']
+    descriptors = descriptor_cache.get(run_start_uid)
+    if descriptors is not None:
+        return descriptors
+    descriptors = list(find_descriptors(run_start_uid))
+    if header['stop'] is not None:
+        descriptor_cache[run_start_uid] = descriptors
+    return descriptors
+
+
+def get_events(headers, fields=None, fill=True, fill_workers=None,
+               prefetch=None, max_workers=None, time_ordered=False,
+               time_range=None, seq_num_range=None):
     """
     Get Events from given run(s).
 
@@ -250,49 +618,304 @@ def get_events(headers, fields=None, fill=True):
         The headers to fetch the events for
     fields : list, optional
         whitelist of field names of interest; if None, all are returned
-    fill : bool, optional
+    fill : bool or 'lazy', optional
         Whether externally-stored data should be filled in. Defaults to True
+        If 'lazy', fill in LazyArray placeholders that read the data only
+        when it is used.
+    fill_workers : int, optional
+        If given, fill events on a pool of this many threads, reading ahead
+        of the consumer. Events are still yielded in order. By default,
+        events are filled one at a time as they are yielded.
+    prefetch : int, optional
+        The most events that may be read ahead when fill_workers is given.
+        This bounds the memory used. Defaults to twice fill_workers.
+    max_workers : int, optional
+        If given, look up the descriptors of all the headers and fetch the
+        events of up to this many descriptors at once, on a pool of threads.
+        Events are still yielded in order. By default, headers and
+        descriptors are visited one after another.
+    time_ordered : bool, optional
+        If True, yield the events of all the descriptors of all the headers
+        merged into one stream in order of time, reading each descriptor's
+        events in step with the others. Only one event per descriptor is
+        held in memory. Cannot be combined with max_workers. False by
+        default, in which case all the events of one descriptor are
+        yielded before any of the next.
+    time_range : tuple, optional
+        (start, stop) in seconds since 1970. Only Events with
+        start <= time < stop are fetched; either bound may be None.
+    seq_num_range : tuple, optional
+        (start, stop). Only Events with start <= seq_num < stop are
+        fetched; either bound may be None.
 
     Yields
     ------
     event : Event
         The event, optionally with non-scalar data filled in
     """
+    criteria = _event_criteria(time_range, seq_num_range)
+    if time_ordered:
+        if max_workers is not None:
+            raise ValueError("time_ordered cannot be combined with "
+                             "max_workers")
+        events = _get_events_by_time(headers, fields, criteria)
+    elif max_workers is None:
+        events = _get_events(headers, fields, criteria)
+    else:
+        events = _get_events_concurrently(headers, fields, max_workers,
+                                          criteria)
+    if not fill:
+        return events
+    if fill == 'lazy':
+        # Placeholders cost nothing to make, so there is nothing to prefetch.
+        return _fill_inline(events, lazy=True)
+    if fill_workers is None:
+        return _fill_inline(events)
+    if prefetch is None:
+        prefetch = 2 * fill_workers
+    return _fill_ahead(events, fill_workers, prefetch)
+
+
+def _event_criteria(time_range, seq_num_range):
+    "Build the query that restricts Events to the given ranges."
+    criteria = {}
+    for name, bounds in (('time', time_range),
+                         ('seq_num', seq_num_range)):
+        if bounds is None:
+            continue
+        try:
+            start, stop = bounds
+        except (TypeError, ValueError):
+            raise ValueError("{0}_range must be a (start, stop) "
+                             "pair".format(name))
+        condition = {}
+        if start is not None:
+            condition['$gte'] = start
+        if stop is not None:
+            condition['$lt'] = stop
+        if condition:
+            criteria[name] = condition
+    return criteria
+
+
+def _get_events(headers, fields, criteria=None):
+    "Yield unfilled events; see get_events."
     # A word about the 'fields' argument:
     # Notice that we assume that the same field name cannot occur in
     # more than one descriptor. We could relax this assumption, but
     # we current enforce it in bluesky, so it is safe for now.
-    try:
-        headers.items()
-    except AttributeError:
-        pass
-    else:
-        headers = [headers]
+    headers = _header_list(headers)
 
     if fields is None:
         fields = []
     fields = set(fields)
 
     for header in headers:
-        descriptors = find_descriptors(header['start']['uid'])
+        descriptors = _header_descriptors(header)
         for descriptor in descriptors:
-            all_fields = set(descriptor['data_keys'])
-            if fields:
-                discard_fields = all_fields - fields
-            else:
-                discard_fields = []
-            if discard_fields == all_fields:
-                continue
-            for event in get_events_generator(descriptor):
-                for field in discard_fields:
-                    del event.data[field]
-                    del event.timestamps[field]
-                if fill:
-                    fill_event(event)
+            for event in _descriptor_events(descriptor, fields, criteria):
                 yield event
 
 
-def get_table(headers, fields=None, fill=True, convert_times=True):
+def _get_events_by_time(headers, fields, criteria=None):
+    "Yield unfilled events in time order; see get_events."
+    headers = _header_list(headers)
+    fields = set(fields or [])
+    streams = []
+    for header in headers:
+        for descriptor in _header_descriptors(header):
+            streams.append(_descriptor_events(descriptor, fields, criteria))
+    for event in _merge_by_time(streams):
+        yield event
+
+
+def _merge_by_time(streams):
+    """
+    Merge streams of events, each already in time order, by time.
+
+    This is a k-way merge that holds one event per stream.
+    """
+    # Decorate each event so that ties are broken by the order of the
+    # streams and then by position within a stream, and Events themselves
+    # are never compared. (heapq.merge has no key argument on Python 2.)
+    decorated = [_decorate(i, stream) for i, stream in enumerate(streams)]
+    for _, _, _, event in heapq.merge(*decorated):
+        yield event
+
+
+def _decorate(i, stream):
+    "Yield (time, i, position, event) for the events of stream number i."
+    for j, event in enumerate(stream):
+        yield event.time, i, j, event
+
+
+def _get_events_concurrently(headers, fields, max_workers, criteria=None):
+    """
+    Yield unfilled events, fetching several descriptors' events at once.
+
+    At most max_workers descriptors' events are held in memory.
+    """
+    headers = _header_list(headers)
+    fields = set(fields or [])
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            descriptor_lists = list(executor.map(
+                propagate(_header_descriptors), headers))
+            for descriptors in descriptor_lists:
+                for descriptor in descriptors:
+                    pending.append(executor.submit(
+                        propagate(_list_descriptor_events), descriptor, fields,
+                        criteria))
+                    if len(pending) >= max_workers:
+                        for event in pending.popleft().result():
+                            yield event
+            while pending:
+                for event in pending.popleft().result():
+                    yield event
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _descriptor_events(descriptor, fields, criteria=None):
+    """
+    Yield the events of one descriptor, projected onto fields.
+
+    If criteria (a query on the Events, such as a time range) are given,
+    only the matching Events are fetched.
+    """
+    keep = _projection(descriptor, fields)
+    if not keep:
+        # None of the requested fields are here. Skip the events.
+        return
+    narrow = len(keep) < len(descriptor_info(descriptor).fields)
+    if narrow and Event is not None:
+        # Have the database leave out the other fields, rather than
+        # fetching every field and dropping most of them here.
+        for event in _find_projected_events(descriptor, keep, criteria):
+            yield event
+        return
+    if criteria:
+        events = _find_descriptor_events(descriptor, criteria)
+    else:
+        events = get_events_generator(descriptor)
+    if not narrow:
+        for event in events:
+            yield event
+        return
+    for event in events:
+        # Copying the few fields we want is cheaper than deleting
+        # the many we do not when the projection is narrow.
+        data, timestamps = event.data, event.timestamps
+        event['data'] = {k: data[k] for k in keep}
+        event['timestamps'] = {k: timestamps[k] for k in keep}
+        yield event
+
+
+def _find_descriptor_events(descriptor, criteria):
+    """
+    Yield the events of one descriptor that match criteria, oldest first,
+    like get_events_generator.
+    """
+    if Event is not None:
+        for event in _find_projected_events(descriptor, None, criteria):
+            yield event
+        return
+    # find_events yields the newest first, so the order is reversed here.
+    events = sorted(find_events(descriptor=descriptor, **criteria),
+                    key=lambda event: event['time'])
+    for event in events:
+        # Make the descriptor a full Document, as get_events_generator does.
+        event['descriptor'] = descriptor
+        yield event
+
+
+def _find_projected_events(descriptor, keep, criteria=None):
+    """
+    Yield the events of one descriptor, oldest first, with only the fields
+    in keep (or every field, if keep is None).
+    """
+    if keep is None:
+        projection = {'_id': 0}
+    else:
+        projection = {'_id': 0, 'uid': 1, 'seq_num': 1, 'time': 1}
+        for field in keep:
+            projection['data.' + field] = 1
+            projection['timestamps.' + field] = 1
+    events = _find_raw_events(descriptor, projection, criteria,
+                              sort=[('time', 1)])
+    for event in events:
+        event.pop('descriptor_id', None)
+        event['descriptor'] = descriptor
+        # An Event with none of the fields has no data left at all.
+        event.setdefault('data', {})
+        event.setdefault('timestamps', {})
+        yield doc.Document('Event', event)
+
+
+def _list_descriptor_events(descriptor, fields, criteria=None):
+    return list(_descriptor_events(descriptor, fields, criteria))
+
+
+def _header_list(headers):
+    "Accept one Header or an iterable of them; return a list."
+    try:
+        headers.items()
+    except AttributeError:
+        return list(headers)
+    else:
+        return [headers]
+
+
+def _projection(descriptor, fields):
+    """
+    Return the sorted fields of a descriptor that are in the whitelist.
+
+    An empty whitelist selects every field.
+    """
+    all_fields = descriptor_info(descriptor).fields
+    if not fields:
+        return all_fields
+    return tuple(field for field in all_fields if field in fields)
+
+
+def _fill_inline(events, lazy=False):
+    for event in events:
+        fill_event(event, lazy)
+        yield event
+
+
+def _filled(event):
+    fill_event(event)
+    return event
+
+
+def _fill_ahead(events, max_workers, depth):
+    """
+    Fill events on a thread pool, keeping at most depth events in flight.
+    """
+    if depth < 1:
+        raise ValueError("prefetch must be at least 1")
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for event in events:
+                pending.append(executor.submit(propagate(_filled), event))
+                if len(pending) >= depth:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # If the consumer stops early, do not wait on reads it will
+            # never use.
+            for future in pending:
+                future.cancel()
+
+
+def get_table(headers, fields=None, fill=True, convert_times=True,
+              stack_arrays=False, max_workers=None, table_cache=None,
+              time_range=None, seq_num_range=None):
     """
     Make a table (pandas.DataFrame) from given run(s).
 
@@ -302,11 +925,33 @@ def get_table(headers, fields=None, fill=True, convert_times=True):
         The headers to fetch the events for
     fields : list, optional
         whitelist of field names of interest; if None, all are returned
-    fill : bool, optional
+    fill : bool or 'lazy', optional
         Whether externally-stored data should be filled in. Defaults to True
+        If 'lazy', fill in LazyArray placeholders that read the data only
+        when it is used.
     convert_times : bool, optional
         Whether to convert times from float (seconds since 1970) to
         numpy datetime64, using pandas. True by default.
+    stack_arrays : bool, optional
+        If True, read each filled field whose descriptor gives a fixed shape
+        into one contiguous N-D array. The column then holds views into
+        that array, which stacked_array recovers without copying. False by
+        default.
+    max_workers : int, optional
+        If given, look up the descriptors of all the headers, and then build
+        the tables of all the descriptors, on a pool of this many threads.
+        The result is the same. By default, headers and descriptors are
+        visited one after another.
+    table_cache : dataportal.broker.table_cache.TableCache, optional
+        If given, load the tables of stopped runs from this on-disk cache,
+        and store them there on first use. Runs without a RunStop bypass
+        the cache, as do tables filled lazily or restricted to a range.
+    time_range : tuple, optional
+        (start, stop) in seconds since 1970. Only Events with
+        start <= time < stop are fetched; either bound may be None.
+    seq_num_range : tuple, optional
+        (start, stop). Only Events with start <= seq_num < stop are
+        fetched; either bound may be None.
 
     Returns
     -------
@@ -316,49 +961,350 @@ def get_table(headers, fields=None, fill=True, convert_times=True):
     # Notice that we assume that the same field name cannot occur in
     # more than one descriptor. We could relax this assumption, but
     # we current enforce it in bluesky, so it is safe for now.
-    try:
-        headers.items()
-    except AttributeError:
-        pass
-    else:
-        headers = [headers]
+    headers = _header_list(headers)
 
     if fields is None:
         fields = []
     fields = set(fields)
+    criteria = _event_criteria(time_range, seq_num_range)
+    if fill == 'lazy' or criteria:
+        # Placeholders cannot be stored on disk, and the cache holds only
+        # whole tables.
+        table_cache = None
 
-    dfs = []
-    for header in headers:
-        descriptors = find_descriptors(header['start']['uid'])
-        for descriptor in descriptors:
-            all_fields = set(descriptor['data_keys'])
-            if fields:
-                discard_fields = all_fields - fields
-            else:
-                discard_fields = []
-            if discard_fields == all_fields:
-                continue
-            is_external = _inspect_descriptor(descriptor)
-
-            payload = get_events_table(descriptor)
-            descriptor, data, seq_nums, times, uids, timestamps = payload
-            df = pd.DataFrame(index=seq_nums)
-            if convert_times:
-                times = pd.to_datetime(
-                    pd.Series(times), unit='s', utc=True).dt.tz_localize(TZ)
-            df['time'] = times
-            for field, values in six.iteritems(data):
-                if field in discard_fields:
-                    logger.debug('Discarding field %s', field)
+    if max_workers is None:
+        dfs = []
+        for header in headers:
+            descriptors = _header_descriptors(header)
+            for descriptor in descriptors:
+                keep = _projection(descriptor, fields)
+                if not keep:
                     continue
-                if is_external[field] and fill:
-                    logger.debug('filling data for %s', field)
-                    # TODO someday we will have bulk retrieve in FS
-                    values = [fs.retrieve(value) for value in values]
-                df[field] = values
-            dfs.append(df)
+                dfs.append(_descriptor_table(
+                    descriptor, keep, fill, convert_times, stack_arrays,
+                    *_table_cache_args(table_cache, header),
+                    criteria=criteria))
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            descriptor_lists = list(executor.map(
+                propagate(_header_descriptors), headers))
+            futures = []
+            for header, descriptors in zip(headers, descriptor_lists):
+                for descriptor in descriptors:
+                    keep = _projection(descriptor, fields)
+                    if not keep:
+                        continue
+                    futures.append(executor.submit(
+                        propagate(_descriptor_table), descriptor, keep, fill,
+                        convert_times, stack_arrays,
+                        *_table_cache_args(table_cache, header),
+                        criteria=criteria))
+            # Collect in submission order, so the result does not depend
+            # on which descriptor finishes first.
+            dfs = [future.result() for future in futures]
     if dfs:
         return pd.concat(dfs)
     else:
         # edge case: no data
         return pd.DataFrame()
+
+
+def _descriptor_table(descriptor, keep, fill, convert_times, stack_arrays,
+                      table_cache=None, run_start_uid=None, criteria=None):
+    "Build the DataFrame of one descriptor's events; see get_table."
+    if table_cache is not None:
+        cached = table_cache.get(run_start_uid, descriptor['uid'], keep, fill)
+        if cached is not None:
+            seq_nums, columns = cached
+            for field, values in six.iteritems(columns):
+                columns[field] = _column(values)
+            return _assemble_table(seq_nums, columns, convert_times)
+
+    info = descriptor_info(descriptor)
+    if Event is not None and len(keep) < len(info.fields):
+        # Have the database send only the fields in keep.
+        data, seq_nums, times = _events_columns(
+            _find_projected_events(descriptor, keep, criteria), keep)
+    elif criteria:
+        data, seq_nums, times = _events_columns(
+            _find_descriptor_events(descriptor, criteria), keep)
+    else:
+        payload = get_events_table(descriptor)
+        descriptor, data, seq_nums, times, uids, timestamps = payload
+    # Build all the columns first, then the DataFrame in one shot.
+    columns = OrderedDict()
+    columns['time'] = np.asarray(times, dtype=np.float64)
+    for field in keep:
+        if field not in data:
+            continue
+        values = data[field]
+        if info.is_external[field] and fill == 'lazy':
+            columns[field] = [LazyArray(value, shape=info.shapes[field])
+                              for value in values]
+        elif info.is_external[field] and fill:
+            logger.debug('filling data for %s', field)
+            # Cached tables are stored as blocks, so stack when caching too.
+            stack = ((stack_arrays or table_cache is not None) and
+                     info.shapes[field] is not None)
+            columns[field] = bulk_retrieve(values, stack=stack)
+        else:
+            columns[field] = _as_block(values)
+
+    if table_cache is not None:
+        if all(isinstance(values, np.ndarray) and not values.dtype.hasobject
+               for values in columns.values()):
+            try:
+                table_cache.put(run_start_uid, descriptor['uid'], keep, fill,
+                                seq_nums, columns)
+            except (IOError, OSError) as err:
+                # A cache must never stop us from returning the data.
+                logger.warning("Could not write to the table cache: %s", err)
+        else:
+            logger.debug("Not caching table of descriptor %s: some columns "
+                         "cannot be stored as blocks", descriptor['uid'])
+    for field, values in six.iteritems(columns):
+        columns[field] = _column(values)
+    return _assemble_table(seq_nums, columns, convert_times)
+
+
+def _events_columns(events, keep):
+    "Transpose events into (data, seq_nums, times) like get_events_table."
+    data = {field: [] for field in keep}
+    seq_nums = []
+    times = []
+    for event in events:
+        seq_nums.append(event['seq_num'])
+        times.append(event['time'])
+        for field in keep:
+            data[field].append(event['data'][field])
+    return data, seq_nums, times
+
+
+def _table_cache_args(table_cache, header):
+    "Only stopped runs may use the table cache; their Events are final."
+    if table_cache is None or header['stop'] is None:
+        return None, None
+    return table_cache, header['start']['uid']
+
+
+def _column(values):
+    """
+    Make a 1D array suitable for a DataFrame column.
+
+    An N-D array becomes an object column whose elements are views of its
+    rows. A list (of filled arrays) becomes an object column of its items.
+    """
+    if isinstance(values, np.ndarray):
+        if values.ndim == 1:
+            return values
+    return _object_column(values)
+
+
+def _as_block(values):
+    "Convert a list of values to an ndarray, leaving ragged lists alone."
+    try:
+        return np.asarray(values)
+    except ValueError:
+        return values
+
+
+def _assemble_table(seq_nums, columns, convert_times):
+    "Make a DataFrame from a dict of columns that includes 'time'."
+    if convert_times:
+        with timed('time_conversion_time'):
+            columns['time'] = pd.to_datetime(
+                pd.Series(columns['time'], index=seq_nums), unit='s',
+                utc=True).dt.tz_localize(TZ)
+    with timed('dataframe_time'):
+        return pd.DataFrame(columns, index=seq_nums, columns=list(columns))
+
+
+def iter_table(headers, fields=None, fill=True, convert_times=True,
+               chunksize=10000, max_bytes=None, time_range=None,
+               seq_num_range=None):
+    """
+    Make a table (pandas.DataFrame) from given run(s), one chunk at a time.
+
+    Events are streamed from the database, so only one chunk needs to fit in
+    memory. Every chunk has the same columns, with the same dtypes, in the
+    same order.
+
+    Parameters
+    ----------
+    headers : Header or iterable of Headers
+        The headers to fetch the events for
+    fields : list, optional
+        whitelist of field names of interest; if None, all are returned
+    fill : bool or 'lazy', optional
+        Whether externally-stored data should be filled in. Defaults to True
+        If 'lazy', fill in LazyArray placeholders that read the data only
+        when it is used.
+    convert_times : bool, optional
+        Whether to convert times from float (seconds since 1970) to
+        numpy datetime64, using pandas. True by default.
+    chunksize : int, optional
+        The most rows per chunk. 10000 by default.
+    max_bytes : int, optional
+        If given, also end a chunk before its estimated size exceeds this
+        many bytes. The estimate uses the shapes in the descriptors,
+        assuming 8 bytes per element. Every chunk has at least one row.
+    time_range : tuple, optional
+        (start, stop) in seconds since 1970. Only Events with
+        start <= time < stop are fetched; either bound may be None.
+    seq_num_range : tuple, optional
+        (start, stop). Only Events with start <= seq_num < stop are
+        fetched; either bound may be None.
+
+    Yields
+    ------
+    table : pandas.DataFrame
+    """
+    headers = _header_list(headers)
+    if chunksize < 1:
+        raise ValueError("chunksize must be at least 1")
+
+    # Decide the columns and their dtypes up front, so that every chunk is
+    # built alike.
+    dtypes = OrderedDict()
+    external = set()
+    row_nbytes = {}
+    for header in headers:
+        for descriptor in _header_descriptors(header):
+            info = descriptor_info(descriptor)
+            keep = _projection(descriptor, fields)
+            nbytes = 8  # time
+            for field in keep:
+                if info.is_external[field]:
+                    external.add(field)
+                    if fill and fill != 'lazy':
+                        nbytes += 8 * int(np.prod(info.shapes[field] or ()))
+                    else:
+                        nbytes += 8
+                else:
+                    nbytes += 8
+                dtypes.setdefault(field, _column_dtype(info, field, fill))
+            row_nbytes[descriptor['uid']] = nbytes
+    columns = sorted(dtypes)
+
+    criteria = _event_criteria(time_range, seq_num_range)
+    events = _get_events(headers, fields, criteria)
+    chunk = []
+    chunk_nbytes = 0
+    for event in events:
+        nbytes = row_nbytes[mc.doc_or_uid_to_uid(event.descriptor)]
+        if chunk and (len(chunk) >= chunksize or
+                      (max_bytes is not None and
+                       chunk_nbytes + nbytes > max_bytes)):
+            yield _table_chunk(chunk, columns, dtypes, external, fill,
+                               convert_times)
+            chunk = []
+            chunk_nbytes = 0
+        chunk.append(event)
+        chunk_nbytes += nbytes
+    if chunk:
+        yield _table_chunk(chunk, columns, dtypes, external, fill,
+                           convert_times)
+
+
+def _column_dtype(info, field, fill):
+    "Choose a dtype for a column that is consistent across chunks."
+    if info.is_external[field] and fill:
+        return object
+    if info.dtypes[field] == 'number' and not info.is_external[field]:
+        # float, not int, so that fields missing from some rows become NaN
+        return np.float64
+    return object
+
+
+def _table_chunk(events, columns, dtypes, external, fill, convert_times):
+    "Build one DataFrame from a list of events; see iter_table."
+    seq_nums = [event.seq_num for event in events]
+    times = [event.time for event in events]
+    table = OrderedDict()
+    if convert_times:
+        with timed('time_conversion_time'):
+            times = pd.to_datetime(
+                pd.Series(times, index=seq_nums), unit='s',
+                utc=True).dt.tz_localize(TZ)
+    else:
+        times = np.asarray(times, dtype=np.float64)
+    table['time'] = times
+    for field in columns:
+        values = [event.data.get(field) for event in events]
+        if field in external and fill == 'lazy':
+            column = _object_column(
+                [LazyArray(value, shape=descriptor_info(
+                    event.descriptor).shapes[field])
+                 if value is not None else None
+                 for event, value in zip(events, values)])
+        elif field in external and fill:
+            present = [i for i, v in enumerate(values) if v is not None]
+            retrieved = bulk_retrieve([values[i] for i in present])
+            column = np.empty(len(values), dtype=object)
+            for i, data in zip(present, retrieved):
+                column[i] = data
+        elif dtypes[field] is object:
+            column = _object_column(values)
+        else:
+            column = np.array(values, dtype=dtypes[field])
+        table[field] = column
+    with timed('dataframe_time'):
+        return pd.DataFrame(table, index=seq_nums, columns=list(table))
+
+
+def _object_column(arrays):
+    """
+    Make a 1D object array whose elements are the given arrays.
+
+    If arrays is one N-D array, the elements are views of its rows, so
+    nothing is copied.
+    """
+    column = np.empty(len(arrays), dtype=object)
+    for i, arr in enumerate(arrays):
+        column[i] = arr
+    return column
+
+
+def stacked_array(column):
+    """
+    Combine a column of same-shape arrays into one N-D array.
+
+    If the column was filled by get_table with stack_arrays=True and holds
+    consecutive rows of the same block, the block (or a slice of it) is
+    returned without copying. Otherwise the arrays are copied into a new
+    array.
+
+    Parameters
+    ----------
+    column : pandas.Series or sequence of arrays
+
+    Returns
+    -------
+    arr : ndarray
+        with shape (len(column),) + shape of each element
+    """
+    arrays = list(column)
+    if not arrays:
+        return np.empty((0,))
+    base = getattr(arrays[0], 'base', None)
+    if (isinstance(arrays[0], np.ndarray) and isinstance(base, np.ndarray)
+            and base.ndim == arrays[0].ndim + 1):
+        start = _row_of(base, arrays[0])
+        if start is not None and all(
+                isinstance(arr, np.ndarray) and arr.base is base and
+                _row_of(base, arr) == start + i
+                for i, arr in enumerate(arrays)):
+            return base[start:start + len(arrays)]
+    return np.array(arrays)
+
+
+def _row_of(base, arr):
+    "Return i such that arr is the view base[i], or None."
+    if arr.shape != base.shape[1:] or arr.strides != base.strides[1:]:
+        return None
+    offset = (arr.__array_interface__['data'][0] -
+              base.__array_interface__['data'][0])
+    i, remainder = divmod(offset, base.strides[0])
+    if remainder or not 0 <= i < len(base):
+        return None
+    return i
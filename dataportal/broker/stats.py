@@ -0,0 +1,218 @@
+"""Counters and timers at the broker's I/O boundaries.
+
+Nothing is recorded unless a collection is in progress, so instrumented code
+pays almost nothing by default. A collection sees only the work of the thread
+(or asyncio task) that started it; the broker hands it on to the worker
+threads it starts with propagate. Concurrent collections on other threads do
+not see each other's work.
+
+Example
+-------
+>>> from dataportal.broker.stats import collect_stats
+>>> with collect_stats() as stats:
+...     table = get_table(DataBroker[-1])
+>>> stats.report()
+OrderedDict([('queries', 3), ('documents', 52), ...])
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+import threading
+import logging
+import numpy as np
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# The quantities that are recorded, in the order they are reported.
+COUNTERS = ('queries', 'documents', 'datums', 'bytes_retrieved')
+TIMERS = ('query_time', 'handler_time', 'time_conversion_time',
+          'dataframe_time')
+
+
+class _ThreadLocalVar(object):
+    "A stand-in for ContextVar, where it is unavailable, with one per thread."
+    def __init__(self, name, default):
+        self._local = threading.local()
+        self._default = default
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        self._local.value = value
+
+
+# The Stats objects collecting in the current context, as a tuple
+if ContextVar is not None:
+    _active = ContextVar('dataportal_stats', default=())
+else:
+    _active = _ThreadLocalVar('dataportal_stats', default=())
+_lock = threading.Lock()  # guards the totals, which several threads update
+
+
+class Stats(object):
+    """
+    Totals recorded while a collect_stats block was active.
+
+    Counters
+    --------
+    queries : number of metadatastore and filestore queries issued
+    documents : number of documents those queries returned
+    datums : number of datums retrieved from filestore
+    bytes_retrieved : size of the arrays the filestore handlers returned
+
+    Timers (seconds)
+    ------
+    query_time : spent waiting on queries, including reading their cursors
+    handler_time : spent in filestore handlers (i.e., reading files)
+    time_conversion_time : spent converting times to local datetimes
+    dataframe_time : spent building DataFrames from columns
+    """
+    def __init__(self):
+        self._totals = OrderedDict((name, 0) for name in COUNTERS)
+        self._totals.update((name, 0.) for name in TIMERS)
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_totals'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def report(self):
+        "Return the totals as an OrderedDict."
+        with _lock:
+            return OrderedDict(self._totals)
+
+    def __repr__(self):
+        items = ', '.join('{0}={1}'.format(k, v) for k, v
+                          in self.report().items())
+        return 'Stats({0})'.format(items)
+
+
+@contextmanager
+def collect_stats():
+    """
+    Record broker I/O while the block runs.
+
+    Blocks may be nested; each collects everything done while it is active
+    by this thread (or asyncio task) and the workers it hands work to.
+
+    Yields
+    ------
+    stats : Stats
+    """
+    stats = Stats()
+    outer = _active.get()
+    _active.set(outer + (stats,))
+    try:
+        yield stats
+    finally:
+        _active.set(outer)
+
+
+def propagate(func):
+    """
+    Make func record into the collections active here, wherever it runs.
+
+    Wrap work with this before handing it to a thread pool.
+    """
+    active = _active.get()
+    if not active:
+        return func
+
+    def wrapper(*args, **kwargs):
+        outer = _active.get()
+        _active.set(active)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _active.set(outer)
+    wrapper.__name__ = getattr(func, '__name__', 'wrapper')
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def record(name, amount=1):
+    "Add amount to a counter or timer of every active collection."
+    active = _active.get()
+    if not active:
+        return
+    with _lock:
+        for stats in active:
+            stats._totals[name] += amount
+
+
+@contextmanager
+def timed(name):
+    "Add the time spent in the block to a timer."
+    if not _active.get():
+        yield
+        return
+    start = default_timer()
+    try:
+        yield
+    finally:
+        record(name, default_timer() - start)
+
+
+def instrument_query(func, count_documents=None):
+    """
+    Wrap a query function so that calls to it are counted and timed.
+
+    Parameters
+    ----------
+    func : callable
+    count_documents : callable, optional
+        Given the result of func, return the number of documents it holds.
+        By default, a list or tuple counts its items, a generator is counted
+        as it is consumed (and the time spent consuming it is counted as
+        query time), and anything else counts as one document.
+    """
+    def wrapper(*args, **kwargs):
+        if not _active.get():
+            return func(*args, **kwargs)
+        record('queries')
+        with timed('query_time'):
+            result = func(*args, **kwargs)
+        if count_documents is not None:
+            record('documents', count_documents(result))
+        elif isinstance(result, (list, tuple)):
+            record('documents', len(result))
+        elif hasattr(result, '__next__') or hasattr(result, 'next'):
+            return _counted(result)
+        else:
+            record('documents')
+        return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def _counted(iterator):
+    "Count and time the documents of a cursor as they are consumed."
+    while True:
+        with timed('query_time'):
+            try:
+                document = next(iterator)
+            except StopIteration:
+                return
+        record('documents')
+        yield document
+
+
+def record_datum(data):
+    "Count one retrieved datum and its size in bytes."
+    if not _active.get():
+        return
+    record('datums')
+    record('bytes_retrieved', getattr(data, 'nbytes', None) or
+           np.asarray(data).nbytes)
@@ -0,0 +1,199 @@
+"""A persistent, on-disk cache of the tables of completed runs.
+
+Each cached table is one directory holding a ``.npy`` file per column and a
+small JSON file of metadata. Uncompressed entries are memory-mapped when they
+are loaded, so even tables with image columns open almost instantly.
+Compressed entries are smaller on disk but must be read in full.
+
+Only stopped runs should be cached: their Events can never change.
+``get_table`` takes care of that.
+
+Example
+-------
+>>> from dataportal.broker.table_cache import TableCache
+>>> cache = TableCache('/tmp/dataportal-tables', max_bytes=20 * 2**30)
+>>> table = get_table(DataBroker[-1], table_cache=cache)  # fills cache
+>>> table = get_table(DataBroker[-1], table_cache=cache)  # reads it
+"""
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import zipfile
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class TableCache(object):
+    """
+    A size-bounded on-disk cache of columnar tables.
+
+    Entries are keyed by run uid, descriptor uid, field set and whether
+    external data was filled. When the cache grows beyond max_bytes, the
+    least recently used entries are deleted.
+
+    Parameters
+    ----------
+    path : str
+        directory to keep the cache in; created if it does not exist
+    max_bytes : int, optional
+        the most bytes the cache may occupy on disk. 10 GiB by default.
+    compress : bool, optional
+        If True, store new entries compressed. Compressed entries cannot be
+        memory-mapped. False by default.
+    """
+    def __init__(self, path, max_bytes=10 * 2**30, compress=False):
+        self.path = os.path.abspath(path)
+        self.max_bytes = max_bytes
+        self.compress = compress
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, run_start_uid, descriptor_uid, fields, fill):
+        key = json.dumps([sorted(fields), bool(fill)])
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.path, run_start_uid,
+                            '{0}-{1}'.format(descriptor_uid, digest))
+
+    def get(self, run_start_uid, descriptor_uid, fields, fill):
+        """
+        Load a table, or return None if it is not cached.
+
+        Returns
+        -------
+        index : ndarray
+        columns : OrderedDict
+            mapping column names to arrays, memory-mapped if possible
+        """
+        entry = self._entry_path(run_start_uid, descriptor_uid, fields,
+                                 fill)
+        meta_path = os.path.join(entry, 'meta.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            arrays = self._load(entry, meta)
+            os.utime(meta_path, None)  # Mark it recently used.
+        except (IOError, OSError, ValueError, KeyError, EOFError,
+                zipfile.BadZipfile) as err:
+            # Missing, or evicted (perhaps by another process) while
+            # being read
+            logger.debug("Table cache miss for %s: %s", entry, err)
+            self.misses += 1
+            return None
+        self.hits += 1
+        index = arrays[0]
+        columns = OrderedDict(zip(meta['columns'], arrays[1:]))
+        return index, columns
+
+    @staticmethod
+    def _load(entry, meta):
+        "Load the index and the columns of an entry, in that order."
+        if meta['compressed']:
+            with np.load(os.path.join(entry, 'table.npz')) as npz:
+                return [npz['index']] + [npz['col{0}'.format(i)] for i
+                                         in range(len(meta['columns']))]
+        names = ['index'] + ['col{0}'.format(i) for i
+                             in range(len(meta['columns']))]
+        # Copy-on-write, so that the arrays are writable like those of a
+        # freshly built table, while the files are never modified.
+        return [np.load(os.path.join(entry, name + '.npy'), mmap_mode='c')
+                for name in names]
+
+    def put(self, run_start_uid, descriptor_uid, fields, fill, index,
+            columns):
+        """
+        Store a table, then evict old entries if the cache is too big.
+
+        Parameters
+        ----------
+        index : array-like
+        columns : OrderedDict
+            mapping column names to ndarrays with numeric, boolean or
+            unicode dtypes (not object)
+        """
+        arrays = [np.asarray(index)] + [np.asarray(arr) for arr
+                                        in columns.values()]
+        for arr in arrays:
+            if arr.dtype.hasobject:
+                raise ValueError("Only arrays without Python objects can be "
+                                 "cached.")
+        entry = self._entry_path(run_start_uid, descriptor_uid, fields,
+                                 fill)
+        run_dir = os.path.dirname(entry)
+        if not os.path.isdir(run_dir):
+            os.makedirs(run_dir)
+        # Write into a temporary directory and move it into place, so that
+        # readers never see a partial entry.
+        tmp = tempfile.mkdtemp(dir=run_dir)
+        try:
+            if self.compress:
+                named = {'index': arrays[0]}
+                for i, arr in enumerate(arrays[1:]):
+                    named['col{0}'.format(i)] = arr
+                np.savez_compressed(os.path.join(tmp, 'table.npz'), **named)
+            else:
+                np.save(os.path.join(tmp, 'index.npy'), arrays[0])
+                for i, arr in enumerate(arrays[1:]):
+                    np.save(os.path.join(tmp, 'col{0}.npy'.format(i)), arr)
+            meta = {'columns': list(columns), 'compressed': self.compress}
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            os.rename(tmp, entry)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self._evict()
+
+    def _entries(self):
+        "List (last used time, size in bytes, path) of every entry."
+        entries = []
+        for run in os.listdir(self.path):
+            run_dir = os.path.join(self.path, run)
+            if not os.path.isdir(run_dir):
+                continue
+            for name in os.listdir(run_dir):
+                entry = os.path.join(run_dir, name)
+                meta_path = os.path.join(entry, 'meta.json')
+                if not os.path.isfile(meta_path):
+                    continue  # being written
+                size = sum(os.path.getsize(os.path.join(entry, f))
+                           for f in os.listdir(entry))
+                entries.append((os.path.getmtime(meta_path), size, entry))
+        return entries
+
+    @property
+    def nbytes(self):
+        "The number of bytes the cache occupies on disk."
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_bytes:
+            _, size, entry = entries.pop(0)
+            logger.debug("Evicting %s from table cache", entry)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+        for run in os.listdir(self.path):
+            run_dir = os.path.join(self.path, run)
+            if os.path.isdir(run_dir) and not os.listdir(run_dir):
+                try:
+                    os.rmdir(run_dir)
+                except OSError:
+                    pass  # Another process is writing into it.
+
+    def clear(self):
+        "Delete every entry."
+        for run in os.listdir(self.path):
+            shutil.rmtree(os.path.join(self.path, run), ignore_errors=True)
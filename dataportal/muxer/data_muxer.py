@@ -42,6 +42,8 @@ import tzlocal
 import numpy as np
 from scipy.interpolate import interp1d
 import pandas.core.groupby  # to get custom exception
+from ..broker.cache import descriptor_info
+from ..broker.retrieval import LazyArray
 
 
 logger = logging.getLogger(__name__)
@@ -396,6 +398,7 @@ class DataMuxer(object):
 
     def _process_new_descriptor(self, descriptor):
         "Build a ColSpec and update state."
+        info = descriptor_info(descriptor)
         for name, description in six.iteritems(descriptor.data_keys):
 
             # If we already have this source name, the unique source
@@ -418,8 +421,8 @@ class DataMuxer(object):
             # If it is a new name, determine a ColSpec.
             else:
                 self.sources[name] = description['source']
-                if 'external' in description and 'shape' in description:
-                    shape = description['shape']
+                if info.is_external[name] and info.shapes[name] is not None:
+                    shape = info.shapes[name]
                     ndim = len(shape)
                 else:
                     # External data can be scalar. Nonscalar data must
@@ -761,10 +764,10 @@ class DataMuxer(object):
                     # Do this lookup here so that strings can be passed
                     # in the call to resample.
                     downsample = ColSpec._downsample_mapping[downsample]
-                downsampled = g.apply(lambda x: downsample(np.asarray(x.dropna())))
-                std_series = g.apply(lambda x: np.std(np.asarray(x.dropna()), 0))
-                max_series = g.apply(lambda x: np.max(np.asarray(x.dropna()), 0))
-                min_series = g.apply(lambda x: np.min(np.asarray(x.dropna()), 0))
+                downsampled = g.apply(lambda x: downsample(_bin_values(x)))
+                std_series = g.apply(lambda x: np.std(_bin_values(x), 0))
+                max_series = g.apply(lambda x: np.max(_bin_values(x), 0))
+                min_series = g.apply(lambda x: np.min(_bin_values(x), 0))
 
             # This (counts[name] > 1) is redundant, but there is no clean way to
             # pass it here without refactoring. Not a huge cost.
@@ -875,6 +878,16 @@ def _build_verified_downsample(downsample, expected_shape):
     return _downsample
 
 
+def _bin_values(series):
+    "Return the non-null values in a bin, reading any LazyArrays."
+    values = np.asarray(series.dropna())
+    if values.dtype.hasobject:
+        for i, value in enumerate(values):
+            if isinstance(value, LazyArray):
+                values[i] = np.asarray(value)
+    return values
+
+
 def _timestamp_col_name(source_name):
     return '{0}_timestamp'.format(source_name)
 
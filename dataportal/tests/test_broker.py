@@ -2,6 +2,10 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import six
+import sys
+import shutil
+import threading
+import tempfile
 import uuid
 import logging
 import time as ttime
@@ -9,14 +13,23 @@ import numpy as np
 import pandas as pd
 from ..sources import channelarchiver as ca
 from ..sources import switch
-from ..broker import DataBroker as db, get_events, get_table
+from ..broker import (DataBroker as db, Header, get_events, get_table,
+                      iter_table, stacked_array)
+from ..broker.simple_broker import header_cache
+from ..broker.retrieval import LazyArray, bulk_retrieve, lazy_readers
+from ..broker.table_cache import TableCache
+from ..broker.stats import collect_stats
+from ..broker.server import DataServer, RemoteDataBroker
+import filestore.api as fs
+from numpy.testing import assert_array_equal
 from ..examples.sample_data import temperature_ramp, image_and_scalar
 from nose.tools import (assert_equal, assert_raises, assert_true,
                         assert_false)
+from nose.plugins.skip import SkipTest
 
 
 from metadatastore.api import (insert_run_start, insert_descriptor,
-                               find_run_starts)
+                               insert_event, find_run_starts)
 from metadatastore.utils.testing import mds_setup, mds_teardown
 from filestore.utils.testing import fs_setup, fs_teardown
 logger = logging.getLogger(__name__)
@@ -139,6 +152,461 @@ def test_indexing():
     assert_equal(scan_ids, [3, 1, 2])
 
 
+def test_bulk_headers():
+    run_starts = list(find_run_starts(owner='nedbrainard'))
+    expected = [Header.from_run_start(rs) for rs in run_starts]
+    actual = Header.from_run_starts(run_starts)
+    assert_equal(len(actual), len(expected))
+    for a, e in zip(actual, expected):
+        assert_equal(a['start']['uid'], e['start']['uid'])
+        assert_equal(a['stop'], e['stop'])
+        assert_equal([d['uid'] for d in a['descriptors']],
+                     [d['uid'] for d in e['descriptors']])
+    # The bulk queries found the RunStops and EventDescriptors at all.
+    assert_true(any(h['stop'] is not None for h in actual))
+    assert_true(all(h['descriptors'] for h in actual))
+    # The run that was never stopped.
+    assert_true(any(h['stop'] is None for h in actual))
+
+    # uids work too, and repeats are preserved
+    uids = [rs['uid'] for rs in run_starts[:2]]
+    headers = Header.from_run_starts(uids + uids[:1])
+    assert_equal([h['start']['uid'] for h in headers], uids + uids[:1])
+
+    assert_equal(Header.from_run_starts([]), [])
+    assert_raises(ValueError, Header.from_run_starts, ['not a real uid'])
+
+
+def test_lazy_headers():
+    headers = db(owner='nedbrainard')
+    assert_true(headers)
+    for h in headers:
+        # Only the RunStart has been loaded so far.
+        assert_true(dict.__contains__(h, 'start'))
+        assert_false(dict.__contains__(h, 'stop'))
+        assert_true(isinstance(h, Header))
+    expected = Header.from_run_start(headers[0]['start']['uid'])
+    assert_equal(headers[0]['descriptors'], expected['descriptors'])
+    # Accessing one Header resolved the whole batch.
+    for h in headers:
+        assert_true(dict.__contains__(h, 'stop'))
+    # Everything dict-like sees the full contents.
+    header = db(owner='nedbrainard')[-1]
+    assert_equal(set(header), {'start', 'stop', 'descriptors'})
+    header = db(owner='nedbrainard')[-1]
+    assert_equal(set(header.keys()), {'start', 'stop', 'descriptors'})
+    header = db(owner='nedbrainard')[-1]
+    assert_equal(header.stop, header['stop'])
+
+    header = Header.from_run_start(expected['start']['uid'], lazy=True)
+    assert_equal(dict(header), dict(expected))
+
+    # Two unresolved Headers of the same (open, so uncached) run are equal.
+    open_uid = [h for h in headers if h['stop'] is None][0]['start']['uid']
+    a, b = db[open_uid], db[open_uid]
+    assert_false(dict.__contains__(a, 'stop'))
+    assert_false(dict.__contains__(b, 'stop'))
+    assert_true(a == b)
+    a, b = db[open_uid], db[open_uid]
+    assert_false(a != b)
+    assert_true(Header.from_run_start(open_uid) == db[open_uid])
+
+
+def test_header_cache():
+    header_cache.clear()
+    stopped, = [h for h in db(owner='docbrown') if h['stop'] is not None][:1]
+    uid = stopped['start']['uid']
+    hits = header_cache.info().hits
+    assert_true(db[uid] is stopped)
+    assert_equal(header_cache.info().hits, hits + 1)
+
+    # Runs without a RunStop are never cached.
+    open_run = [h for h in db(owner='nedbrainard') if h['stop'] is None][0]
+    assert_false(open_run['start']['uid'] in header_cache)
+
+
+def test_bulk_retrieve():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    events = list(get_events(header, ['img'], fill=False))
+    datum_ids = [ev.data['img'] for ev in events]
+    datum_ids += datum_ids[:2]  # repeats are allowed
+    expected = [fs.retrieve(datum_id) for datum_id in datum_ids]
+    actual = bulk_retrieve(datum_ids)
+    assert_equal(len(actual), len(expected))
+    for a, e in zip(actual, expected):
+        assert_array_equal(a, e)
+    assert_equal(bulk_retrieve([]), [])
+
+    stacked = bulk_retrieve(datum_ids, stack=True)
+    assert_array_equal(stacked, np.array(expected))
+    out = np.empty_like(stacked)
+    assert_true(bulk_retrieve(datum_ids, out=out) is out)
+    # Data is never cast silently into out.
+    assert_raises(ValueError, bulk_retrieve, datum_ids,
+                  out=np.empty(stacked.shape, dtype=np.float32))
+
+    table = get_table(header, ['img'])
+    for a, e in zip(table['img'], expected):
+        assert_array_equal(a, e)
+
+
+def test_fields():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    fields = ['linear_motor', 'Tsam']
+    events = list(get_events(header, fields, fill=False))
+    assert_true(events)
+    full = {event.uid: event for event in get_events(header, fill=False)}
+    for event in events:
+        assert_true(set(event.data) <= set(fields))
+        assert_equal(set(event.data), set(event.timestamps))
+        # The projected Events agree with the whole ones.
+        other = full[event.uid]
+        assert_equal(event.seq_num, other.seq_num)
+        assert_equal(event.time, other.time)
+        assert_equal(event.descriptor['uid'], other.descriptor['uid'])
+        for field in event.data:
+            assert_equal(event.data[field], other.data[field])
+    time_range = (events[1].time, events[-1].time)
+    ranged = list(get_events(header, fields, fill=False,
+                             time_range=time_range))
+    assert_equal([event.uid for event in ranged],
+                 [event.uid for event in events
+                  if time_range[0] <= event.time < time_range[1]])
+    assert_equal(set(get_table(header, fields).columns),
+                 set(fields) | {'time'})
+    # A narrow table, fetched with a projection, agrees with the full one.
+    full = get_table(header, convert_times=False)
+    for kwargs in ({}, {'time_range': (-1e9, None)}):
+        narrow = get_table(header, fields, convert_times=False, **kwargs)
+        assert_equal(list(narrow['time']), list(full['time']))
+        for field in fields:
+            assert_array_equal(narrow[field].values, full[field].values)
+    assert_equal(list(get_events(header, ['not a field'])), [])
+
+
+def test_stacked_table():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    expected = get_table(header, ['img'])
+    table = get_table(header, ['img'], stack_arrays=True)
+    assert_equal(list(table.columns), list(expected.columns))
+    block = stacked_array(table['img'])
+    assert_equal(block.shape, (len(table),) + table['img'].iloc[0].shape)
+    assert_true(block.base is table['img'].iloc[0].base)  # not a copy
+    for a, e in zip(block, expected['img']):
+        assert_array_equal(a, e)
+    # a subset of rows is still a view
+    assert_true(stacked_array(table['img'].iloc[2:5]).base is block.base)
+
+    # Columns of separate arrays are copied into a new one.
+    copied = stacked_array(expected['img'])
+    assert_array_equal(copied, block)
+    # Elements that are not arrays do not confuse it.
+    assert_array_equal(stacked_array([1.5, 2.5]), [1.5, 2.5])
+
+    # Scalar columns are built with their natural dtypes.
+    table = get_table(header, ['linear_motor'])
+    assert_equal(table['linear_motor'].dtype.kind, 'f')
+    assert_equal(table['time'].dtype.kind, 'M')
+
+
+def test_iter_table():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    expected = get_table(header)
+    chunks = list(iter_table(header, chunksize=7))
+    assert_true(len(chunks) > 1)
+    assert_true(all(len(chunk) <= 7 for chunk in chunks))
+    for chunk in chunks:
+        assert_equal(list(chunk.columns), list(chunks[0].columns))
+        assert_equal(list(chunk.dtypes), list(chunks[0].dtypes))
+    actual = pd.concat(chunks)
+    assert_equal(len(actual), len(expected))
+    assert_equal(set(actual.columns), set(expected.columns))
+    for a, e in zip(actual['img'].dropna(), expected['img'].dropna()):
+        assert_array_equal(a, e)
+
+    # A byte budget smaller than one row still makes progress.
+    chunks = list(iter_table(header, ['img'], max_bytes=1))
+    assert_true(all(len(chunk) == 1 for chunk in chunks))
+
+    chunks = list(iter_table(header, ['linear_motor'], convert_times=False))
+    assert_equal(chunks[0]['time'].dtype, np.float64)
+    assert_equal(chunks[0]['linear_motor'].dtype, np.float64)
+
+
+def test_lazy_fill():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    expected = get_table(header, ['img'])
+    table = get_table(header, ['img'], fill='lazy')
+    assert_equal(len(table), len(expected))
+    for lazy, e in zip(table['img'], expected['img']):
+        assert_true(isinstance(lazy, LazyArray))
+        assert_array_equal(np.asarray(lazy), e)
+        assert_array_equal(lazy[1:3], e[1:3])
+        # The descriptor's shape is a hint; once read, the data's is used.
+        assert_equal(lazy.shape, e.shape)
+
+    events = list(get_events(header, ['img'], fill='lazy'))
+    for event, e in zip(events, expected['img']):
+        assert_true(isinstance(event.data['img'], LazyArray))
+        assert_array_equal(event.data['img'].read(), e)
+
+    chunk = next(iter_table(header, ['img'], fill='lazy'))
+    assert_true(isinstance(chunk['img'].iloc[0], LazyArray))
+    assert_array_equal(np.asarray(chunk['img'].iloc[0]), expected['img'].iloc[0])
+
+    # A resource that cannot be memory-mapped is only looked up once.
+    reader = lazy_readers.pop('npy')
+    try:
+        lazy = LazyArray(table['img'].iloc[0].datum_id)
+        np.asarray(lazy)
+        with collect_stats() as stats:
+            assert_array_equal(np.asarray(lazy), expected['img'].iloc[0])
+        assert_equal(stats.queries, 0)
+        assert_equal(stats.datums, 1)
+    finally:
+        lazy_readers['npy'] = reader
+
+
+def test_ranges():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    # One descriptor, so that its seq_nums are distinct
+    expected = get_table(header, ['img'], convert_times=False)
+    seq_nums = list(expected.index)
+
+    table = get_table(header, ['img'],
+                      seq_num_range=(seq_nums[2], seq_nums[5]))
+    assert_equal(list(table.index), seq_nums[2:5])  # oldest first
+    for a, e in zip(table['img'], expected['img'].iloc[2:5]):
+        assert_array_equal(a, e)
+
+    times = list(expected['time'])
+    table = get_table(header, ['img'], convert_times=False,
+                      time_range=(times[-3], None))
+    assert_equal(list(table['time']), times[-3:])
+
+    events = list(get_events(header, ['img'], fill=False,
+                             seq_num_range=(None, seq_nums[3])))
+    assert_equal([ev.seq_num for ev in events], seq_nums[:3])
+
+    # Every stream of the merge is in time order.
+    events = list(get_events(header, fill=False, time_ordered=True,
+                             time_range=(times[1], times[-1])))
+    assert_true(events)
+    assert_equal([ev.time for ev in events],
+                 sorted(ev.time for ev in events))
+
+    chunks = list(iter_table(header, ['img'],
+                             seq_num_range=(seq_nums[1], None)))
+    assert_equal(sum(len(chunk) for chunk in chunks), len(seq_nums) - 1)
+
+    assert_raises(ValueError, get_table, header, time_range=5)
+
+
+def test_table_cache():
+    path = tempfile.mkdtemp()
+    try:
+        cache = TableCache(path)
+        header, = db(owner='docbrown', scan_id=1)  # the run with images
+        expected = get_table(header)
+        first = get_table(header, table_cache=cache)
+        assert_true(cache.nbytes > 0)
+        second = get_table(header, table_cache=cache)
+        assert_true(cache.hits > 0)
+        for actual in (first, second):
+            assert_equal(list(actual.columns), list(expected.columns))
+            assert_equal(list(actual['time']), list(expected['time']))
+            for a, e in zip(actual['img'].dropna(), expected['img'].dropna()):
+                assert_array_equal(a, e)
+        # Frames from the cache are writable, like freshly read ones.
+        img = second['img'].dropna().iloc[0]
+        img -= 1
+        third = get_table(header, table_cache=cache)
+        assert_array_equal(third['img'].dropna().iloc[0],
+                           expected['img'].dropna().iloc[0])
+
+        # Runs without a RunStop are never cached.
+        open_run = [h for h in db(owner='nedbrainard')
+                    if h['stop'] is None][0]
+        cache.clear()
+        get_table(open_run, table_cache=cache)
+        assert_equal(cache.nbytes, 0)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_fill_ahead():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    expected = list(get_events(header))
+    actual = list(get_events(header, fill_workers=2, prefetch=3))
+    assert_equal([ev.uid for ev in actual], [ev.uid for ev in expected])
+    for a, e in zip(actual, expected):
+        assert_array_equal(a.data['img'], e.data['img'])
+
+    # Stopping early is fine.
+    events = get_events(header, ['img'], fill_workers=2)
+    next(events)
+    events.close()
+
+    assert_raises(ValueError, list,
+                  get_events(header, fill_workers=2, prefetch=0))
+
+
+def test_concurrent_headers():
+    headers = db(owner='docbrown')
+    expected = [ev.uid for ev in get_events(headers, fill=False)]
+    actual = [ev.uid for ev in get_events(headers, fill=False,
+                                          max_workers=3)]
+    assert_equal(actual, expected)
+
+    expected = get_table(headers, fill=False)
+    actual = get_table(headers, fill=False, max_workers=3)
+    assert_equal(list(actual.columns), list(expected.columns))
+    assert_equal(list(actual.index), list(expected.index))
+    assert_equal(list(actual['time']), list(expected['time']))
+
+
+def test_time_ordered_events():
+    headers = db(owner='docbrown')
+    expected = list(get_events(headers, fill=False))
+    actual = list(get_events(headers, fill=False, time_ordered=True))
+    assert_equal(sorted(ev.uid for ev in actual),
+                 sorted(ev.uid for ev in expected))
+    times = [ev.time for ev in actual]
+    assert_equal(times, sorted(times))
+
+    assert_raises(ValueError, get_events, headers, time_ordered=True,
+                  max_workers=2)
+
+    # Ties in time are broken by descriptor order, never by comparing Events.
+    run_start = insert_run_start(time=0., scan_id=1, owner='drtie',
+                                 beamline_id='example', uid=str(uuid.uuid4()))
+    for name in ['x', 'y']:
+        descriptor = insert_descriptor(
+            run_start=run_start, time=0., uid=str(uuid.uuid4()),
+            data_keys={name: {'source': '_', 'dtype': 'number'}})
+        for i in range(3):
+            insert_event(descriptor=descriptor, seq_num=i + 1,
+                         time=float(i), data={name: i},
+                         timestamps={name: float(i)}, uid=str(uuid.uuid4()))
+    events = list(get_events(db[run_start], time_ordered=True))
+    assert_equal([ev.time for ev in events], [0., 0., 1., 1., 2., 2.])
+    order = [ev.descriptor['uid'] for ev in events]
+    assert_true(order[0] != order[1])
+    assert_equal(order, order[:2] * 3)
+
+
+def test_stats():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    with collect_stats() as outer:
+        with collect_stats() as stats:
+            table = get_table(header, ['img'])
+        get_table(header, ['img'], fill=False)
+    report = stats.report()
+    assert_equal(list(report)[:4],
+                 ['queries', 'documents', 'datums', 'bytes_retrieved'])
+    assert_true(stats.queries > 0)
+    assert_true(stats.documents >= len(table))
+    assert_equal(stats.datums, len(table))
+    assert_equal(stats.bytes_retrieved,
+                 sum(img.nbytes for img in table['img']))
+    assert_true(stats.handler_time > 0)
+    assert_true(stats.dataframe_time > 0)
+    # The outer block also saw the second call, which read no datums.
+    assert_true(outer.queries > stats.queries)
+    assert_equal(outer.datums, stats.datums)
+
+    # Nothing is recorded outside of a block.
+    get_table(header, ['img'])
+    assert_equal(stats.report(), report)
+
+    # Work handed to worker threads is counted by the caller's collection,
+    # and a collection on another thread sees none of it.
+    elsewhere = []
+
+    def collect_elsewhere():
+        with collect_stats() as other:
+            get_table(header, ['img'], fill=False)
+        elsewhere.append(other)
+
+    with collect_stats() as pooled:
+        thread = threading.Thread(target=collect_elsewhere)
+        thread.start()
+        get_table(header, ['img'], max_workers=2)
+        list(get_events(header, ['img'], fill_workers=2))
+        thread.join()
+    assert_equal(pooled.datums, 2 * len(table))
+    assert_equal(elsewhere[0].datums, 0)
+
+
+def test_server():
+    header, = db(owner='docbrown', scan_id=1)  # the run with images
+    server = DataServer()
+    server.start()
+    try:
+        remote = RemoteDataBroker(server.url)
+        remote_header = remote[header['start']['uid']]
+        assert_equal(remote_header['start']['uid'], header['start']['uid'])
+        assert_equal(len(remote_header['descriptors']),
+                     len(header['descriptors']))
+        assert_equal(len(remote(owner='docbrown')), len(db(owner='docbrown')))
+
+        expected = get_table(header)
+        # 'img' is missing from the rows of the other descriptors.
+        assert_true(expected['img'].isnull().any())
+        for _ in range(2):  # The second time comes from the cache.
+            actual = remote.get_table(remote_header)
+            assert_equal(list(actual.columns), list(expected.columns))
+            assert_equal(list(actual['time']), list(expected['time']))
+            for a, e in zip(actual['img'], expected['img']):
+                assert_array_equal(a, e)
+        assert_equal(server.table_cache.hits, 1)
+
+        datum_id = next(get_events(header, ['img'], fill=False)).data['img']
+        assert_array_equal(remote.retrieve(datum_id), fs.retrieve(datum_id))
+
+        assert_raises(ValueError, remote.__getitem__, 'not a uid')
+    finally:
+        server.shutdown()
+
+
+def test_async_broker():
+    if sys.version_info < (3, 6):
+        raise SkipTest("dataportal.broker.aio requires Python 3.6")
+    import asyncio
+    from ..broker.aio import AsyncDataBroker
+    adb = AsyncDataBroker(max_concurrency=2)
+    try:
+        for _ in range(2):  # a new event loop each time
+            loop = asyncio.new_event_loop()
+            try:
+                headers = loop.run_until_complete(adb(owner='docbrown'))
+                # The Headers were resolved off the event loop.
+                for h in headers:
+                    assert_true(dict.__contains__(h, 'descriptors'))
+                header = loop.run_until_complete(adb[-1])
+                assert_true(dict.__contains__(header, 'descriptors'))
+                assert_equal(header['start']['uid'], db[-1]['start']['uid'])
+
+                header, = db(owner='docbrown', scan_id=1)
+                actual = loop.run_until_complete(adb.get_table(header))
+                expected = get_table(header)
+                assert_equal(list(actual.columns), list(expected.columns))
+                assert_equal(list(actual['time']), list(expected['time']))
+
+                events = adb.get_events(header, ['img'], batch_size=3)
+                for other in get_events(header, ['img']):
+                    event = loop.run_until_complete(events.__anext__())
+                    assert_equal(event['uid'], other['uid'])
+                    assert_array_equal(event['data']['img'],
+                                       other['data']['img'])
+                assert_raises(StopAsyncIteration, loop.run_until_complete,
+                              events.__anext__())
+            finally:
+                loop.close()
+    finally:
+        adb.close()
+
+
 def test_scan_id_lookup():
     rd1 = [insert_run_start(time=float(i), scan_id=i + 1 + 314159,
                             owner='docbrown', beamline_id='example',
@@ -176,6 +644,48 @@ def test_uid_lookup():
     # using first char (will error)
     assert_raises(ValueError, lambda: db[uid[0]])
 
+    # regex metacharacters are taken literally
+    assert_raises(ValueError, lambda: db['.*'])
+
+    # A full uid that is also a prefix of another known uid is exact.
+    short = str(uuid.uuid4())
+    insert_run_start(time=100., scan_id=1, uid=short,
+                     owner='drstrangelove', beamline_id='example')
+    insert_run_start(time=100., scan_id=1, uid=short + '-rerun',
+                     owner='drstrangelove', beamline_id='example')
+    db(owner='drstrangelove')  # Both are now in the prefix index.
+    assert_equal(db[short]['start']['uid'], short)
+    assert_raises(ValueError, lambda: db[short[:-1]])
+
+
+def test_explain():
+    uid = insert_run_start(time=100., scan_id=1, owner='drmanhattan',
+                           beamline_id='example', uid=str(uuid.uuid4()))
+    insert_descriptor(run_start=uid, time=100., uid=str(uuid.uuid4()),
+                      data_keys={'spork': {'source': '_',
+                                           'dtype': 'number'}})
+    plan = db.explain(owner='drmanhattan')
+    assert_equal(len(plan), 1)
+    assert_equal(plan[0].query, {'owner': 'drmanhattan'})
+    assert_equal(plan[0].count, 1)
+    assert_equal(db.explain(estimate=False, owner='drmanhattan')[0].count,
+                 None)
+
+    # A data_key search also looks up the runs it has not indexed.
+    plan = db.explain(owner='drmanhattan', data_key='spork')
+    assert_equal(len(plan), 3)
+    # RunStarts are referred to by ObjectId, not uid.
+    clause, = plan[1].query['$and']
+    assert_equal(list(clause), ['run_start_id'])
+    assert_equal(len(clause['run_start_id']['$in']), 1)
+    assert_false(uid in clause['run_start_id']['$in'])
+    assert_equal(plan[1].count, 0)  # no RunStop
+    assert_equal(plan[2].count, 1)
+
+    # Costly criteria are pointed out.
+    plan = db.explain(owner={'$regex': 'manhattan'})
+    assert_true(any('anchored' in note for note in plan[0].notes))
+
 
 def test_data_key():
     rs1_uid = insert_run_start(time=100., scan_id=1,
@@ -200,6 +710,13 @@ def test_data_key():
     actual = result2[0]['start']['uid']
     assert_equal(actual, str(rs2.uid))
 
+    # Runs without a RunStop can gain new data keys after being indexed.
+    insert_descriptor(run_start=rs1_uid, data_keys={'knife': data_keys['fork']},
+                      time=300., uid=str(uuid.uuid4()))
+    result3 = db(data_key='knife')
+    assert_equal(len(result3), 1)
+    assert_equal(result3[0]['start']['uid'], str(rs1.uid))
+
 
 def generate_ca_data(channels, start_time, end_time):
     timestamps = pd.date_range(start_time, end_time, freq='T').to_series()
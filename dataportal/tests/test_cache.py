@@ -0,0 +1,134 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from nose.tools import assert_equal, assert_true, assert_false
+
+from collections import namedtuple, OrderedDict
+import os
+import shutil
+import tempfile
+import uuid
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from ..broker.cache import LRUCache, descriptor_info
+from ..broker.table_cache import TableCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert_equal(cache.get('a'), 1)  # 'b' is now least recently used
+    cache['c'] = 3
+    assert_false('b' in cache)
+    assert_true('a' in cache)
+    assert_true('c' in cache)
+    assert_equal(len(cache), 2)
+
+    cache.maxsize = 1
+    assert_equal(len(cache), 1)
+    assert_true('c' in cache)
+
+
+def test_lru_counters():
+    cache = LRUCache(maxsize=None)
+    cache['a'] = 1
+    cache.get('a')
+    cache.get('a')
+    assert_equal(cache.get('nope', 'default'), 'default')
+    info = cache.info()
+    assert_equal(info.hits, 2)
+    assert_equal(info.misses, 1)
+    assert_equal(info.currsize, 1)
+    cache.clear()
+    assert_equal(cache.info(), (0, 0, None, 0))
+
+
+def test_lru_getsizeof():
+    cache = LRUCache(maxsize=10, getsizeof=len)
+    cache['a'] = 'xxxx'
+    cache['b'] = 'xxxx'
+    assert_equal(cache.currsize, 8)
+    cache['c'] = 'xxxx'
+    assert_false('a' in cache)
+    assert_equal(cache.currsize, 8)
+    cache['d'] = 'x' * 11  # larger than the whole cache; not stored
+    assert_false('d' in cache)
+    assert_equal(cache.pop('b'), 'xxxx')
+    assert_equal(cache.currsize, 4)
+
+
+def test_descriptor_info():
+    Descriptor = namedtuple('Descriptor', ['uid', 'data_keys'])
+    data_keys = {'img': {'source': '_', 'dtype': 'array', 'shape': [5, 5],
+                         'external': 'FILESTORE:'},
+                 'Tsam': {'source': '_', 'dtype': 'number'}}
+    descriptor = Descriptor(str(uuid.uuid4()), data_keys)
+    info = descriptor_info(descriptor)
+    assert_equal(info.fields, ('Tsam', 'img'))
+    assert_equal(info.external_keys, {'img'})
+    assert_equal(info.is_external, {'img': True, 'Tsam': False})
+    assert_equal(info.shapes, {'img': (5, 5), 'Tsam': None})
+    assert_equal(info.dtypes, {'img': 'array', 'Tsam': 'number'})
+    # memoized by uid
+    assert_true(descriptor_info(descriptor) is info)
+
+
+def _check_table_cache(compress):
+    path = tempfile.mkdtemp()
+    try:
+        cache = TableCache(path, compress=compress)
+        columns = OrderedDict([('time', np.arange(3, dtype=float)),
+                               ('img', np.ones((3, 2, 2))),
+                               ('name', np.array(['a', 'b', 'c']))])
+        assert_equal(cache.get('run', 'desc', ['img', 'name'], True), None)
+        cache.put('run', 'desc', ['img', 'name'], True, [1, 2, 3], columns)
+        index, actual = cache.get('run', 'desc', ['name', 'img'], True)
+        assert_array_equal(index, [1, 2, 3])
+        assert_equal(list(actual), list(columns))
+        for name in columns:
+            assert_array_equal(actual[name], columns[name])
+        if not compress:
+            assert_true(isinstance(actual['img'], np.memmap))
+        # Loaded arrays may be modified without changing the entry.
+        actual['img'] -= 1
+        index, again = cache.get('run', 'desc', ['name', 'img'], True)
+        assert_array_equal(again['img'], columns['img'])
+        # The key includes the field set and the fill flag.
+        assert_equal(cache.get('run', 'desc', ['img'], True), None)
+        assert_equal(cache.get('run', 'desc', ['img', 'name'], False), None)
+        assert_equal((cache.hits, cache.misses), (2, 3))
+        assert_true(cache.nbytes > 0)
+        # Data deleted from under the metadata (e.g., by another process
+        # evicting the entry) is a miss.
+        entry = cache._entry_path('run', 'desc', ['img', 'name'], True)
+        os.remove(os.path.join(entry, 'table.npz' if compress
+                               else 'col1.npy'))
+        assert_equal(cache.get('run', 'desc', ['img', 'name'], True), None)
+        assert_equal(cache.misses, 4)
+        cache.clear()
+        assert_equal(cache.nbytes, 0)
+    finally:
+        shutil.rmtree(path)
+
+
+def test_table_cache():
+    for compress in (False, True):
+        yield _check_table_cache, compress
+
+
+def test_table_cache_eviction():
+    path = tempfile.mkdtemp()
+    try:
+        columns = OrderedDict([('x', np.zeros(1000))])
+        cache = TableCache(path, max_bytes=20000)
+        cache.put('run1', 'desc', ['x'], True, np.arange(1000), columns)
+        cache.put('run2', 'desc', ['x'], True, np.arange(1000), columns)
+        # Only one entry fits.
+        assert_equal(cache.get('run1', 'desc', ['x'], True), None)
+        assert_false(cache.get('run2', 'desc', ['x'], True) is None)
+        assert_true(cache.nbytes <= 20000)
+        cache.put('run3', 'desc', ['x'], True, [], OrderedDict())
+        cache.get('run3', 'desc', [], True)
+    finally:
+        shutil.rmtree(path)
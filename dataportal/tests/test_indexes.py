@@ -0,0 +1,44 @@
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+from nose.tools import assert_equal, assert_true, assert_false
+
+from ..broker.indexes import DataKeyIndex, UidPrefixIndex
+
+
+def test_data_key_index():
+    index = DataKeyIndex()
+    index.add('a', ['motor1', 'det'], complete=True)
+    index.add('b', ['motor1'])
+    assert_equal(index.runs_with('motor1'), {'a', 'b'})
+    assert_equal(index.runs_with('det'), {'a'})
+    assert_equal(index.runs_with('nope'), set())
+    assert_true('a' in index)
+    assert_false('b' in index)  # still open, so not completely indexed
+    assert_equal(index.unindexed(['a', 'b', 'c']), ['b', 'c'])
+
+    # Open runs can gain new keys.
+    index.add('b', ['det'], complete=True)
+    assert_equal(index.runs_with('det'), {'a', 'b'})
+    assert_equal(index.unindexed(['a', 'b']), [])
+
+    index.clear()
+    assert_equal(len(index), 0)
+    assert_equal(index.runs_with('motor1'), set())
+
+
+def test_uid_prefix_index():
+    index = UidPrefixIndex()
+    index.update(['b8812e', 'a23k0f', 'a23jslk', 'a23k0f'])
+    assert_equal(len(index), 3)
+    assert_true('a23k0f' in index)
+    assert_false('a23' in index)
+    assert_equal(index.matches('a23'), ['a23jslk', 'a23k0f'])
+    assert_equal(index.matches('a23', limit=1), ['a23jslk'])
+    assert_equal(index.matches('b'), ['b8812e'])
+    assert_equal(index.matches('c'), [])
+    assert_equal(len(index.matches('')), 3)
+
+    # A batch is merged with what is already known.
+    index.update(['a23a', 'c0', 'b8812e', 'a24'])
+    assert_equal(index.matches(''),
+                 ['a23a', 'a23jslk', 'a23k0f', 'a24', 'b8812e', 'c0'])
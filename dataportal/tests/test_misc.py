@@ -1,12 +1,16 @@
 from ..utils.diagnostics import watermark
-from ..broker.pims_readers import Images, get_images
-from ..broker import DataBroker as db
+from ..broker.pims_readers import Images, get_images, frame_cache
+from ..broker import DataBroker as db, get_table
+from ..broker.stats import collect_stats
 from ..examples.sample_data import image_and_scalar
 from metadatastore.utils.testing import mds_setup, mds_teardown
 from filestore.utils.testing import fs_setup, fs_teardown
+from filestore.file_writers import save_ndarray
+from metadatastore.api import insert_run_start, insert_descriptor, insert_event
+import uuid
 import numpy as np
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 from numpy.testing.utils import assert_array_equal
 
 def test_watermark():
@@ -30,6 +34,133 @@ def test_pims_images():
     assert_equal(len(images), image_and_scalar.num1)
 
 
+def test_pims_images_paged():
+    header = db[-1]
+    images = Images(header, 'img', page_size=3)
+    assert_equal(len(images), image_and_scalar.num1)
+    assert_equal(len(images._pages), 0)  # nothing looked up yet
+    expected = get_table(header, ['img'])['img']
+    for i in [0, 4, 3, len(images) - 1, -2]:
+        assert_array_equal(images.get_frame(i), expected.iloc[i])
+    assert_equal(len(images._pages), 3)
+    assert_raises(IndexError, images.get_frame, len(images))
+    assert_raises(IndexError, images.get_frame, -len(images) - 1)
+
+
+def test_pims_images_prefetch():
+    header = db[-1]
+    expected = get_table(header, ['img'])['img']
+    images = Images(header, 'img', prefetch=3)
+    try:
+        for i in range(4):  # sequential
+            assert_array_equal(images.get_frame(i), expected.iloc[i])
+        assert_equal(sorted(images._read_ahead._futures), [4, 5, 6])
+        for i in [12, 10, 8]:  # reverse, with a stride of 2
+            assert_array_equal(images.get_frame(i), expected.iloc[i])
+        assert_equal(sorted(images._read_ahead._futures), [2, 4, 6])
+        images.get_frame(15)  # a seek cancels the stale reads
+        assert_equal(len(images._read_ahead._futures), 0)
+    finally:
+        images.close()
+
+
+def test_pims_images_cache():
+    header = db[-1]
+    frame_cache.clear()
+    images = Images(header, 'img')
+    first = images.get_frame(0)
+    assert_equal(frame_cache.info().misses, 1)
+    # Another Images over the same datums shares the cache.
+    again = Images(header, 'img').get_frame(0)
+    assert_array_equal(again, first)
+    # Frames are copies, so they may be modified in place.
+    first -= 1
+    assert_array_equal(images.get_frame(0), again)
+    info = Images.cache_info()
+    assert_equal(info.hits, 2)
+    assert_equal(info.currsize, first.nbytes)
+
+    # The budget is in bytes.
+    frame_cache.maxsize = first.nbytes
+    images.get_frame(1)
+    assert_equal(len(frame_cache), 1)
+    frame_cache.maxsize = 512 * 2**20
+
+    uncached = Images(header, 'img', cache=False)
+    uncached.get_frame(2)
+    assert_equal(len(frame_cache), 1)
+
+
+def test_pims_images_get_frames():
+    header = db[-1]
+    expected = np.array(list(get_table(header, ['img'])['img']))
+    images = Images(header, 'img', cache=False)
+    assert_array_equal(images.get_frames(slice(2, 9, 3)), expected[2:9:3])
+    assert_array_equal(images.get_frames([0, -1, 4]), expected[[0, -1, 4]])
+    mask = np.arange(len(images)) % 4 == 0
+    assert_array_equal(images.get_frames(mask), expected[mask])
+    assert_equal(images.get_frames([]).shape, (0,) + expected.shape[1:])
+
+    # Cached frames are used; the rest are read.
+    cached = Images(header, 'img')
+    cached.get_frame(3)
+    assert_array_equal(cached.get_frames(slice(2, 6)), expected[2:6])
+
+    assert_raises(ValueError, images.get_frames, mask[:-1])
+    assert_raises(IndexError, images.get_frames, [len(images)])
+    assert_raises(IndexError, images.get_frames, [-len(images) - 1])
+
+
+def test_pims_images_metadata():
+    header = db[-1]
+    images = Images(header, 'img')
+    with collect_stats() as stats:
+        shape, dtype = images.frame_shape, images.pixel_type
+    assert_equal(stats.datums, 0)  # learned without reading a frame
+    assert_equal(shape, images.get_frame(0).shape)
+    assert_equal(dtype, images.get_frame(0).dtype)
+
+    # A second run with smaller frames
+    run_start = insert_run_start(time=0., scan_id=2, owner='test',
+                                 beamline_id='example',
+                                 uid=str(uuid.uuid4()))
+    descriptor = insert_descriptor(
+        run_start=run_start, time=0., uid=str(uuid.uuid4()),
+        data_keys={'img': dict(source='CCD', shape=(3, 4), dtype='array',
+                               external='FILESTORE:')})
+    for i in range(3):
+        insert_event(descriptor=descriptor, seq_num=i, time=float(i),
+                     data={'img': save_ndarray(np.ones((3, 4)))},
+                     timestamps={'img': float(i)}, uid=str(uuid.uuid4()))
+    images = Images([header, db[run_start]], 'img')
+    assert_equal(images.frame_shapes, [shape, (3, 4)])
+    assert_equal(images.uniform_shape, False)
+    assert_equal(images.get_frames(slice(-3, None)).shape, (3, 3, 4))
+    assert_raises(ValueError, images.get_frames, slice(None))
+
+
+def test_pims_images_seq_num_gaps():
+    # seq_nums that start late and skip some values
+    run_start = insert_run_start(time=0., scan_id=3, owner='test',
+                                 beamline_id='example',
+                                 uid=str(uuid.uuid4()))
+    descriptor = insert_descriptor(
+        run_start=run_start, time=0., uid=str(uuid.uuid4()),
+        data_keys={'img': dict(source='CCD', shape=(2, 2), dtype='array',
+                               external='FILESTORE:')})
+    seq_nums = [5, 6, 7, 20, 21, 40]
+    for seq_num in seq_nums:
+        insert_event(descriptor=descriptor, seq_num=seq_num,
+                     time=float(seq_num),
+                     data={'img': save_ndarray(seq_num * np.ones((2, 2)))},
+                     timestamps={'img': float(seq_num)},
+                     uid=str(uuid.uuid4()))
+    images = Images(db[run_start], 'img', page_size=4)
+    assert_equal(len(images), len(seq_nums))
+    for i, seq_num in enumerate(seq_nums):
+        assert_array_equal(images.get_frame(i), seq_num * np.ones((2, 2)))
+
+
 def setup():
     mds_setup()
     fs_setup()
@@ -12,10 +12,28 @@ except ImportError:
         from distutils.core import setup
 
 
+# Modules that use syntax newer than some supported Pythons, and the oldest
+# Python that can import each
+NEWER_MODULES = {('dataportal.broker', 'aio'): (3, 6)}
+
+cmdclass = versioneer.get_cmdclass()
+_build_py = cmdclass['build_py']
+
+
+class build_py(_build_py):
+    "Leave out the modules that this Python cannot even compile."
+    def find_package_modules(self, package, package_dir):
+        modules = _build_py.find_package_modules(self, package, package_dir)
+        return [m for m in modules if
+                sys.version_info >= NEWER_MODULES.get(m[:2], (0,))]
+
+cmdclass['build_py'] = build_py
+
+
 setup(
     name='dataportal',
     version=versioneer.get_version(),
-    cmdclass=versioneer.get_cmdclass(),
+    cmdclass=cmdclass,
     author='Brookhaven National Laboratory',
     packages=['dataportal', 'dataportal.api', 'dataportal.testing',
               'dataportal.examples',